@@ -0,0 +1,483 @@
+import os
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from checkpoint import resolve
+from config import cfg
+from main import call_session
+import npengine
+from reader import Prefetcher, QueueFeeder, Reader, Vocab
+from rnnlm import RNNLMModel
+import rnncell
+import utils
+
+
+def cpu_session():
+    '''A session that only uses the CPU.'''
+    return tf.Session(config=tf.ConfigProto(device_count={'GPU': 0}))
+
+
+def time_run(session, fetches, f_dict=None, warmup=2):
+    '''Average seconds per session.run of fetches.'''
+    for _ in range(warmup):
+        session.run(fetches, f_dict)
+    start_time = time.time()
+    for _ in range(cfg.bench_steps):
+        session.run(fetches, f_dict)
+    return (time.time() - start_time) / cfg.bench_steps
+
+
+def run_memory(session, fetches, f_dict=None):
+    '''Total and largest peak allocator bytes of one session.run of fetches, from the step
+       stats.'''
+    run_metadata = tf.RunMetadata()
+    session.run(fetches, f_dict, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                run_metadata=run_metadata)
+    total = peak = 0
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            for memory in node_stats.memory:
+                total += memory.total_bytes
+                peak = max(peak, memory.peak_bytes)
+    return total, peak
+
+
+def bench_gru():
+    '''Per-step CPU time of the generator GRU (forward and backward), standard cells against
+       hoisted input projections, sharing the same variables.'''
+    inputs = np.random.uniform(-1.0, 1.0, [cfg.batch_size, cfg.max_sent_length, cfg.emb_size])
+    with tf.Graph().as_default(), cpu_session() as session:
+        inputs = tf.constant(inputs.astype(np.float32))
+        with tf.variable_scope("Generator"):
+            cell = rnncell.MultiRNNCell([rnncell.GRUCell(cfg.hidden_size, pretanh=True)
+                                         for _ in range(cfg.num_layers)], return_states=True,
+                                        pretanh=True, structured=True)
+            standard, _ = tf.nn.dynamic_rnn(cell, inputs, swap_memory=True, dtype=tf.float32)
+        with tf.variable_scope("Generator", reuse=True):
+            hoisted, _ = rnncell.hoisted_rnn(inputs, cfg.num_layers, cfg.hidden_size,
+                                             pretanh=True)
+        standard = tf.concat(2, tf.nn.nest.flatten(standard))
+        hoisted = tf.concat(2, tf.nn.nest.flatten(hoisted))
+        tvars = tf.trainable_variables()
+        steps = [('GRUCell', tf.gradients(tf.reduce_sum(standard), tvars)),
+                 ('hoisted', tf.gradients(tf.reduce_sum(hoisted), tvars))]
+        tf.initialize_all_variables().run()
+        diff = session.run(tf.reduce_max(tf.abs(standard - hoisted)))
+        print('Max output difference: %g' % diff)
+        times = {}
+        for name, step in steps:
+            times[name] = time_run(session, step)
+            print('%-8s %8.1f ms/step  %6.3f ms/timestep' % (name, 1000 * times[name],
+                                                              1000 * times[name] /
+                                                              cfg.max_sent_length))
+        print('Speedup: %.2fx' % (times['GRUCell'] / times['hoisted']))
+
+
+def bench_outputs():
+    '''Per-step CPU time and allocated memory of the free-running generator (forward and
+       backward), with return_states outputs concatenated into one tensor and sliced apart
+       against structured outputs. Meant for the char model at its full sentence length
+       (--char_model --char_sent_length 512).'''
+    vocab = Vocab()
+    vocab.load()
+    vocab_size = len(vocab.vocab)
+    data = np.random.randint(0, vocab_size, [cfg.batch_size, cfg.max_sent_length])
+    with tf.Graph().as_default(), cpu_session() as session:
+        embedding = tf.get_variable('embedding', [vocab_size, cfg.emb_size],
+                                    initializer=tf.random_uniform_initializer(-1.0, 1.0))
+        softmax_w = tf.get_variable('softmax_w', [vocab_size, cfg.hidden_size],
+                                    initializer=tf.contrib.layers.xavier_initializer())
+        softmax_b = tf.get_variable('softmax_b', [vocab_size], initializer=tf.zeros_initializer)
+        inputs = tf.nn.embedding_lookup(embedding, tf.constant(data.astype(np.int32)))
+        steps = []
+        for structured in [False, True]:
+            with tf.variable_scope("Generator", reuse=structured):
+                cell = rnncell.MultiRNNCell([rnncell.GRUCell(cfg.hidden_size, pretanh=True)
+                                             for _ in range(cfg.num_layers)], embedding,
+                                            softmax_w, softmax_b, return_states=True,
+                                            pretanh=True, get_embeddings=cfg.concat_inputs,
+                                            structured=structured)
+                outputs, _ = tf.nn.dynamic_rnn(cell, inputs, swap_memory=True, dtype=tf.float32)
+            if structured:
+                name = 'structured'
+                output = outputs.output
+                generated = rnncell.prediction_ids(outputs.prediction)
+                states = tf.concat(2, list(outputs.states))
+            else:
+                name = 'concat'
+                skip = cfg.hidden_size + 1
+                if cfg.concat_inputs:
+                    skip += cfg.emb_size
+                output = outputs[:, :, :cfg.hidden_size]
+                generated = tf.cast(outputs[:, :, cfg.hidden_size], tf.int32)
+                states = outputs[:, :, skip:]
+            tvars = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope='Generator')
+            grads = tf.gradients(tf.reduce_sum(output) + tf.reduce_sum(states), tvars)
+            steps.append((name, [generated] + grads))
+        tf.initialize_all_variables().run()
+        times = {}
+        for name, step in steps:
+            times[name] = time_run(session, step)
+            total, peak = run_memory(session, step)
+            print('%-10s %8.1f ms/step  %8.1f MB allocated  %8.1f MB peak' %
+                  (name, 1000 * times[name], total / 2**20, peak / 2**20))
+        print('Speedup: %.2fx' % (times['concat'] / times['structured']))
+
+
+def bench_recompute():
+    '''Per-step CPU time and memory of the bidirectional recurrent discriminator (forward and
+       backward) with hoisted input projections, against recomputing segments of several lengths
+       (including --recompute_every) in the backward pass.'''
+    state_size = 2 * cfg.hidden_size
+    if cfg.concat_inputs:
+        state_size += cfg.emb_size
+    states = np.random.uniform(-1.0, 1.0, [2 * cfg.batch_size, cfg.max_sent_length, state_size])
+    lengths = sorted(set([8, 16, 32, 64, cfg.recompute_every]) - set([0]))
+    with tf.Graph().as_default(), cpu_session() as session:
+        states = tf.constant(states.astype(np.float32))
+        steps = []
+        for i, length in enumerate([0] + lengths):
+            with tf.variable_scope("Discriminator", reuse=i > 0):
+                if length:
+                    name = 'k=%d' % length
+                    outputs = [rnncell.recompute_rnn(states, cfg.d_num_layers, cfg.hidden_size,
+                                                     length, reverse=reverse, scope=scope)[0]
+                               for reverse, scope in [(False, 'BiRNN_FW'), (True, 'BiRNN_BW')]]
+                else:
+                    name = 'hoisted'
+                    outputs = [rnncell.hoisted_rnn(states, cfg.d_num_layers, cfg.hidden_size,
+                                                   reverse=reverse, scope=scope)[0]
+                               for reverse, scope in [(False, 'BiRNN_FW'), (True, 'BiRNN_BW')]]
+            outputs = tf.concat(2, [tf.concat(2, tf.nn.nest.flatten(out)) for out in outputs])
+            tvars = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope='Discriminator')
+            steps.append((name, outputs, tf.gradients(tf.reduce_sum(outputs), tvars)))
+        tf.initialize_all_variables().run()
+        baseline = session.run(steps[0][1])
+        for name, outputs, grads in steps:
+            diff = np.max(np.abs(session.run(outputs) - baseline))
+            step_time = time_run(session, grads)
+            total, peak = run_memory(session, grads)
+            print('%-8s %8.1f ms/step  %8.1f MB allocated  %8.1f MB peak  max diff %g' %
+                  (name, 1000 * step_time, total / 2**20, peak / 2**20, diff))
+
+
+def bench_precision():
+    '''Validation perplexity and time per batch of the model computed in float32 against
+       --compute_dtype, sharing the same float32 variables (restored from --load_file if
+       given), as a parity check of reduced precision.'''
+    compute_dtype = cfg.dtype
+    if compute_dtype == tf.float32:
+        print('Choose a reduced precision with --compute_dtype')
+        return
+    vocab = Vocab()
+    vocab.load()
+    reader = Reader(vocab)
+    with tf.Graph().as_default(), cpu_session() as session:
+        models = []
+        with tf.variable_scope("Model") as scope:
+            for dtype in [tf.float32, compute_dtype]:
+                cfg.dtype = dtype
+                models.append((dtype.name, RNNLMModel(vocab, False, False)))
+                scope.reuse_variables()
+        cfg.dtype = compute_dtype
+        if cfg.load_file:
+            tf.train.Saver().restore(session, resolve(cfg.load_file))
+        else:
+            tf.initialize_all_variables().run()
+        nlls = {name: [] for name, _ in models}
+        times = {name: 0.0 for name, _ in models}
+        for step, batch in enumerate(reader.validation()):
+            if step > cfg.bench_steps:
+                break
+            for name, model in models:
+                if cfg.stateful:
+                    state = [np.zeros(s.get_shape().as_list(), dtype=np.float32)
+                             for s in model.initial_state]
+                else:
+                    state = None
+                start_time = time.time()
+                nll = call_session(session, model, batch, eval_d=False, state=state)[0]
+                if step > 0:  # the first batch is warmup
+                    times[name] += time.time() - start_time
+                nlls[name].append(nll)
+        num_batches = len(nlls['float32'])
+        perps = {}
+        for name, _ in models:
+            perps[name] = np.exp(np.mean(nlls[name]) / cfg.max_sent_length)
+            print('%-8s perplexity %10.3f  %8.1f ms/batch' %
+                  (name, perps[name], 1000 * times[name] / max(num_batches - 1, 1)))
+        diff = np.max(np.abs(np.array(nlls['float32']) - np.array(nlls[compute_dtype.name])))
+        print('Perplexity difference: %.3f%%  max batch nll difference: %.4f' %
+              (100 * abs(perps[compute_dtype.name] / perps['float32'] - 1), diff))
+
+
+def bench_eval_softmax():
+    '''Validation perplexity, time and memory per batch of evaluation models computing all the
+       logits at once against the chunked softmax (--eval_vocab_chunk and
+       --eval_position_chunk), sharing the same variables.'''
+    vocab_chunk = cfg.eval_vocab_chunk
+    if vocab_chunk <= 0:
+        print('Choose a vocab chunk size with --eval_vocab_chunk')
+        return
+    vocab = Vocab()
+    vocab.load()
+    reader = Reader(vocab)
+    with tf.Graph().as_default(), cpu_session() as session:
+        models = []
+        with tf.variable_scope("Model") as scope:
+            for name, chunk in [('full', 0), ('chunked', vocab_chunk)]:
+                cfg.eval_vocab_chunk = chunk
+                models.append((name, RNNLMModel(vocab, False, False)))
+                scope.reuse_variables()
+        cfg.eval_vocab_chunk = vocab_chunk
+        if cfg.load_file:
+            tf.train.Saver().restore(session, resolve(cfg.load_file))
+        else:
+            tf.initialize_all_variables().run()
+        batches = [batch for _, batch in zip(range(cfg.bench_steps), reader.validation())]
+        nlls = {}
+        for name, model in models:
+            if cfg.stateful:
+                f_dicts = [{model.data: batch[:, :-1], model.next_tokens: batch[:, -1]}
+                           for batch in batches]
+            else:
+                f_dicts = [{model.data: batch} for batch in batches]
+            session.run(model.nll, f_dicts[0])
+            start_time = time.time()
+            nlls[name] = np.array([session.run(model.nll, f_dict) for f_dict in f_dicts])
+            batch_time = (time.time() - start_time) / len(f_dicts)
+            total, peak = run_memory(session, model.nll, f_dicts[0])
+            print('%-8s perplexity %10.3f  %8.1f ms/batch  %8.1f MB allocated  %8.1f MB peak' %
+                  (name, np.exp(np.mean(nlls[name]) / cfg.max_sent_length), 1000 * batch_time,
+                   total / 2**20, peak / 2**20))
+        print('Max batch nll difference: %g' % np.max(np.abs(nlls['full'] - nlls['chunked'])))
+
+
+def bench_adaptive():
+    '''MLE training step time, free-running sampling time and validation perplexity after
+       --bench_steps training steps from the same seed, with the existing softmax (sampled for
+       training) against the adaptive softmax (--softmax_cutoffs).'''
+    vocab = Vocab()
+    vocab.load()
+    reader = Reader(vocab)
+    adaptive = cfg.adaptive_softmax
+    for name, use_adaptive in [('softmax', False), ('adaptive', True)]:
+        cfg.adaptive_softmax = use_adaptive
+        with tf.Graph().as_default(), cpu_session() as session:
+            tf.set_random_seed(cfg.shuffle_seed)
+            with tf.variable_scope("Model") as scope:
+                optimizer = utils.get_optimizer(cfg.g_learning_rate, cfg.g_optimizer)
+                model = RNNLMModel(vocab, True, False, g_optimizer=optimizer,
+                                   d_optimizer=optimizer)
+                scope.reuse_variables()
+                eval_model = RNNLMModel(vocab, False, False)
+            tf.initialize_all_variables().run()
+            if cfg.stateful:
+                state = [np.zeros(s.get_shape().as_list(), dtype=np.float32)
+                         for s in model.initial_state]
+            else:
+                state = None
+            train_time = 0.0
+            for step, batch in enumerate(reader.training()):
+                if step > cfg.bench_steps:
+                    break
+                start_time = time.time()
+                call_session(session, model, batch, eval_d=False, state=state)
+                if step > 0:  # the first step is warmup
+                    train_time += time.time() - start_time
+            sample_time = time_run(session, model.generated,
+                                   {model.data: np.zeros([cfg.batch_size, cfg.max_sent_length],
+                                                         dtype=np.int32)})
+            nlls = []
+            for step, batch in enumerate(reader.validation()):
+                if step >= cfg.bench_steps:
+                    break
+                nlls.append(call_session(session, eval_model, batch, eval_d=False,
+                                         state=state)[0])
+            print('%-8s %8.1f ms/train step  %8.1f ms/sampled batch  perplexity %10.3f' %
+                  (name, 1000 * train_time / cfg.bench_steps, 1000 * sample_time,
+                   np.exp(np.mean(nlls) / cfg.max_sent_length)))
+    cfg.adaptive_softmax = adaptive
+
+
+def bench_eval_graph():
+    '''Graph build time, graph size, and validation time and memory per batch of the full
+       evaluation model (scoring the discriminator too, like validation did) against the lean
+       MLE-only one.'''
+    vocab = Vocab()
+    vocab.load()
+    reader = Reader(vocab)
+    batches = [batch for _, batch in zip(range(cfg.bench_steps), reader.validation())]
+    for name, eval_only in [('full', False), ('lean', True)]:
+        with tf.Graph().as_default() as graph, cpu_session() as session:
+            start_time = time.time()
+            with tf.variable_scope("Model"):
+                model = RNNLMModel(vocab, False, cfg.use_gan, eval_only=eval_only)
+            build_time = time.time() - start_time
+            tf.initialize_all_variables().run()
+            if cfg.stateful:
+                state = [np.zeros(s.get_shape().as_list(), dtype=np.float32)
+                         for s in model.initial_state]
+                f_dict = {model.data: batches[0][:, :-1], model.next_tokens: batches[0][:, -1]}
+            else:
+                state = None
+                f_dict = {model.data: batches[0]}
+            call_session(session, model, batches[0], eval_d=model.use_gan, state=state)
+            start_time = time.time()
+            for batch in batches:
+                call_session(session, model, batch, eval_d=model.use_gan, state=state)
+            batch_time = (time.time() - start_time) / len(batches)
+            fetches = [model.nll]
+            if model.use_gan:
+                fetches.extend([model.d_cost, model.g_cost])
+            total, peak = run_memory(session, fetches, f_dict)
+            print('%-5s %7.2f s build  %7d ops  %8.1f ms/batch  %8.1f MB allocated  '
+                  '%8.1f MB peak' % (name, build_time, len(graph.get_operations()),
+                                     1000 * batch_time, total / 2**20, peak / 2**20))
+
+
+def bench_npengine():
+    '''Largest difference between the per-position losses of the evaluation model and of the
+       NumPy engine on the same weights (restored from --load_file if given), with the startup
+       and time per batch of both.'''
+    vocab = Vocab()
+    vocab.load()
+    reader = Reader(vocab)
+    batches = [batch for _, batch in zip(range(cfg.bench_steps), reader.validation())]
+    tmp_dir = tempfile.mkdtemp()
+    checkpoint = os.path.join(tmp_dir, 'model.dat')
+    with tf.Graph().as_default(), cpu_session() as session:
+        start_time = time.time()
+        with tf.variable_scope("Model"):
+            model = RNNLMModel(vocab, False, False, eval_only=True)
+        saver = tf.train.Saver()
+        if cfg.load_file:
+            saver.restore(session, resolve(cfg.load_file))
+        else:
+            tf.initialize_all_variables().run()
+        tf_startup = time.time() - start_time
+        checkpoint = saver.save(session, checkpoint)
+        tf_losses = []
+        start_time = time.time()
+        for batch in batches:
+            if cfg.stateful:
+                f_dict = {model.data: batch[:, :-1], model.next_tokens: batch[:, -1]}
+            else:
+                f_dict = {model.data: batch}
+            tf_losses.append(session.run(model.losses, f_dict))
+        tf_time = (time.time() - start_time) / len(batches)
+    weights = os.path.join(tmp_dir, 'model.npz')
+    npengine.export(checkpoint, weights)
+    start_time = time.time()
+    engine = npengine.Engine.load(weights)
+    np_startup = time.time() - start_time
+    max_diff = 0.0
+    start_time = time.time()
+    for batch, losses in zip(batches, tf_losses):
+        if cfg.stateful:
+            np_losses = engine.losses(batch[:, :-1], vocab.unk_index, batch[:, -1])
+        else:
+            np_losses = engine.losses(batch, vocab.unk_index)
+        max_diff = max(max_diff, np.max(np.abs(np_losses - losses)))
+    np_time = (time.time() - start_time) / len(batches)
+    print('tensorflow %7.3f s startup  %8.1f ms/batch' % (tf_startup, 1000 * tf_time))
+    print('numpy      %7.3f s startup  %8.1f ms/batch' % (np_startup, 1000 * np_time))
+    print('Largest loss difference: %g' % max_diff)
+
+
+def bench_input_queue():
+    '''MLE training step time with the batches fed through feed_dict (from a Prefetcher)
+       against dequeued from the in-graph input queue.'''
+    vocab = Vocab()
+    vocab.load()
+    reader = Reader(vocab)
+    for name, input_queue in [('feed', False), ('queue', True)]:
+        with tf.Graph().as_default(), cpu_session() as session:
+            with tf.variable_scope("Model"):
+                optimizer = utils.get_optimizer(cfg.g_learning_rate, cfg.g_optimizer)
+                model = RNNLMModel(vocab, True, False, g_optimizer=optimizer,
+                                   d_optimizer=optimizer, input_queue=input_queue)
+            tf.initialize_all_variables().run()
+            if cfg.stateful:
+                state = [np.zeros(s.get_shape().as_list(), dtype=np.float32)
+                         for s in model.initial_state]
+            else:
+                state = None
+            if input_queue:
+                batches = QueueFeeder(session, model, reader.training())
+            else:
+                batches = Prefetcher(reader.training(), max(cfg.prefetch_batches, 1))
+            for step, batch in enumerate(batches):
+                if step == 1:  # the first step is warmup
+                    start_time = time.time()
+                ret = call_session(session, model, batch, eval_d=False, state=state)
+                if cfg.stateful:
+                    state = ret[-1]
+                if step == cfg.bench_steps:
+                    break
+            train_time = (time.time() - start_time) / step
+            batches.close()
+            print('%-5s %8.1f ms/train step' % (name, 1000 * train_time))
+
+
+def bench_towers():
+    '''Training step throughput with 1, 2, 4 and 8 towers on random batches, and its scaling
+       efficiency against a single tower.'''
+    vocab = Vocab()
+    vocab.load()
+    width = cfg.max_sent_length + 1 if cfg.stateful else cfg.max_sent_length
+    base_speed = None
+    for num_towers in [1, 2, 4, 8]:
+        with tf.Graph().as_default(), tf.Session() as session:
+            with tf.variable_scope("Model"):
+                optimizer = utils.get_optimizer(cfg.g_learning_rate, cfg.g_optimizer)
+                model = RNNLMModel(vocab, True, cfg.use_gan, g_optimizer=optimizer,
+                                   d_optimizer=optimizer, num_towers=num_towers)
+            tf.initialize_all_variables().run()
+            batch = np.random.randint(0, len(vocab.vocab), [num_towers * cfg.batch_size, width])
+            if cfg.stateful:
+                state = [np.zeros(s.get_shape().as_list(), dtype=np.float32)
+                         for s in model.initial_state]
+            else:
+                state = None
+            for step in range(cfg.bench_steps + 1):
+                if step == 1:  # the first step is warmup
+                    start_time = time.time()
+                ret = call_session(session, model, batch, train_d=cfg.use_gan,
+                                   train_g=cfg.use_gan, state=state)
+                if cfg.stateful:
+                    state = ret[-1]
+            step_time = (time.time() - start_time) / cfg.bench_steps
+        speed = num_towers * cfg.batch_size / step_time
+        if base_speed is None:
+            base_speed = speed
+        print('%d towers %8.1f ms/step %8.0f rows/sec  scaling efficiency: %.0f%%' %
+              (num_towers, 1000 * step_time, speed, 100 * speed / (num_towers * base_speed)))
+
+
+benchmarks = {
+    'gru': bench_gru,
+    'outputs': bench_outputs,
+    'recompute': bench_recompute,
+    'precision': bench_precision,
+    'eval_softmax': bench_eval_softmax,
+    'adaptive': bench_adaptive,
+    'eval_graph': bench_eval_graph,
+    'npengine': bench_npengine,
+    'input_queue': bench_input_queue,
+    'towers': bench_towers,
+}
+
+
+def main(_):
+    if cfg.bench not in benchmarks:
+        print('Choose a benchmark with --bench:', ', '.join(sorted(benchmarks)))
+        return
+    benchmarks[cfg.bench]()
+
+
+if __name__ == '__main__':
+    tf.app.run()
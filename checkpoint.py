@@ -0,0 +1,170 @@
+import glob
+import json
+import os
+import pickle
+import queue
+import threading
+import time
+
+import tensorflow as tf
+
+
+def checkpoint_files(prefix):
+    '''The existing files of the checkpoint saved to prefix: the saver's files (V1 or V2
+       format) and the training state.'''
+    paths = [prefix] + [prefix + suffix for suffix in ['.state', '.index', '.meta']]
+    return ([path for path in paths if os.path.exists(path)] +
+            glob.glob(glob.escape(prefix) + '.data-*'))
+
+
+def load_manifest(save_file):
+    '''The entries of the manifest of the checkpoints saved to save_file (and its numbered
+       variants), empty if there is none.'''
+    try:
+        with open(save_file + '.manifest', 'r') as f:
+            return json.load(f)
+    except IOError:
+        return []
+
+
+def resolve(path):
+    '''The prefix of the files of the checkpoint a Checkpointer saved to path, as listed in
+       its manifest, or path itself for checkpoints saved directly.'''
+    save_files = [path]
+    base, _, suffix = path.rpartition('.')
+    if suffix.isdigit():
+        save_files.append(base)
+    for save_file in save_files:
+        for entry in load_manifest(save_file):
+            if os.path.normpath(entry['path']) == os.path.normpath(path):
+                return entry.get('prefix', entry['path'])
+    return path
+
+
+class Checkpointer(object):
+
+    '''Saves checkpoints of the variables of a session from a background thread. Training is
+       only blocked for a snapshot of the variable values, which the writer thread copies into
+       a shadow graph of the same variables and saves under their names. Every save writes its
+       files (with the training state) to a fresh prefix, <save_file>.ckpt-<id>, and the
+       manifest next to the save file maps save files to the prefixes of their checkpoints.
+       Rewriting the manifest is the only commit point: a crash before it leaves the previous
+       checkpoint of the save file intact (and unlisted files behind), and the files of
+       replaced or retired checkpoints are only deleted after it. Loading goes through
+       resolve(). With keep_last > 0, only the keep_last most recent checkpoints and the
+       keep_best with the lowest validation perplexity are kept.'''
+
+    def __init__(self, session, save_file, keep_last=0, keep_best=0):
+        self.session = session
+        self.variables = tf.all_variables()
+        # (name, dtype, shape) of the variables, for the shadow graph
+        self.specs = [(v.op.name, v.dtype.base_dtype, v.get_shape()) for v in self.variables]
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.manifest_file = save_file + '.manifest'
+        self.manifest = load_manifest(save_file)
+        self.next_id = max([e.get('id', 0) for e in self.manifest] + [0]) + 1
+        self.last_save = None  # save_file of the latest save(), reset by the caller per epoch
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, save_file, train_state=None, train_perplexity=None):
+        '''Snapshot the variables to be saved to save_file, with the training state to resume
+           from next to it. Returns the seconds training was blocked, waiting for the previous
+           checkpoint to be written (only one is in flight) and taking the snapshot.'''
+        start_time = time.time()
+        self.wait()
+        values = self.session.run(self.variables)
+        if train_perplexity is not None:
+            train_perplexity = float(train_perplexity)
+        self.queue.put((save_file, values, train_state, train_perplexity))
+        self.last_save = save_file
+        return time.time() - start_time
+
+    def validated(self, save_file, perplexity):
+        '''Record the validation perplexity of the checkpoint saved to save_file.'''
+        self.wait()
+        for entry in self.manifest:
+            if entry['path'] == save_file:
+                entry['valid_perplexity'] = float(perplexity)
+                self._commit(self._retain())
+                break
+
+    def wait(self):
+        '''Wait for the queued checkpoint to be written, raising the writer's error if any.'''
+        self.queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        shadow = None
+        while True:
+            save_file, values, train_state, train_perplexity = self.queue.get()
+            try:
+                start_time = time.time()
+                if shadow is None:
+                    shadow = self._shadow()
+                session, saver, placeholders, init_op = shadow
+                session.run(init_op, dict(zip(placeholders, values)))
+                prefix = '%s.ckpt-%d' % (save_file, self.next_id)
+                saver.save(session, prefix, write_meta_graph=False)
+                if train_state is not None:
+                    with open(prefix + '.state', 'wb') as f:
+                        pickle.dump(train_state, f, -1)
+                # the previous checkpoint of the save file is replaced
+                removed = [e for e in self.manifest if e['path'] == save_file]
+                self.manifest = [e for e in self.manifest if e['path'] != save_file]
+                self.manifest.append({'path': save_file, 'prefix': prefix, 'id': self.next_id,
+                                      'train_perplexity': train_perplexity,
+                                      'valid_perplexity': None})
+                self.next_id += 1
+                self._commit(removed + self._retain())
+                print("Saved to %s in %.2fs" % (save_file, time.time() - start_time))
+            except Exception as e:  # re-raised by the next save
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _shadow(self):
+        '''A CPU session with a copy of every variable, assigned from placeholders, and a saver
+           of the copies under the names of the originals.'''
+        graph = tf.Graph()
+        with graph.as_default():
+            placeholders = []
+            shadows = {}
+            for name, dtype, shape in self.specs:
+                placeholder = tf.placeholder(dtype, shape)
+                placeholders.append(placeholder)
+                shadows[name] = tf.Variable(placeholder, trainable=False, collections=[])
+            init_op = tf.group(*[v.initializer for v in shadows.values()])
+            saver = tf.train.Saver(shadows, max_to_keep=0)
+        session = tf.Session(graph=graph, config=tf.ConfigProto(device_count={'GPU': 0}))
+        return session, saver, placeholders, init_op
+
+    def _retain(self):
+        '''Drop the checkpoints that are neither among the keep_last most recent nor the
+           keep_best with the lowest validation perplexity from the manifest, returning their
+           entries.'''
+        if self.keep_last <= 0:
+            return []
+        keep = set(e['path'] for e in self.manifest[-self.keep_last:])
+        validated = sorted((e for e in self.manifest if e['valid_perplexity'] is not None),
+                           key=lambda e: e['valid_perplexity'])
+        keep.update(e['path'] for e in validated[:self.keep_best])
+        removed = [e for e in self.manifest if e['path'] not in keep]
+        self.manifest = [e for e in self.manifest if e['path'] in keep]
+        for entry in removed:
+            print("Removed checkpoint", entry['path'])
+        return removed
+
+    def _commit(self, removed):
+        '''Write the manifest, then delete the files of the removed checkpoints.'''
+        with open(self.manifest_file + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(self.manifest_file + '.tmp', self.manifest_file)
+        for entry in removed:
+            for path in checkpoint_files(entry.get('prefix', entry['path'])):
+                os.remove(path)
@@ -9,10 +9,18 @@ cfg = flags.FLAGS
 flags.DEFINE_string ("data_path",       "data_ptb",          "Data path")
 flags.DEFINE_string ("save_file",       "models/recent.dat", "Save file")
 flags.DEFINE_string ("load_file",       "",                  "File to load model from")
+flags.DEFINE_string ("train_files",     "train.txt",         "Glob of training data shard files in "
+                                                             "data path")
 flags.DEFINE_string ("word_vocab_file", "wvocab.pk",         "Word vocab pickle file in data path")
 flags.DEFINE_string ("char_vocab_file", "cvocab.pk",         "Character vocab pickle file in data "
                                                              "path")
 
+flags.DEFINE_bool   ("binary_corpus",     False,   "Read the pre-tokenized, memory-mapped corpus "
+                                                   "(compiled from the text files on first use)")
+flags.DEFINE_bool   ("cache_corpus",      False,   "Keep the tokenized data in memory after the first "
+                                                   "epoch (for small corpora)")
+flags.DEFINE_integer("vocab_workers",     0,       "Processes for building the vocab (0 for one per "
+                                                   "CPU)")
 flags.DEFINE_bool   ("preallocate_gpu",   True,    "Preallocate all of the GPU memory")
 flags.DEFINE_bool   ("char_model",        False,   "Character-level model")
 flags.DEFINE_bool   ("use_gan",           True,    "Use adversatial objectives")
@@ -23,6 +31,28 @@ flags.DEFINE_integer("num_layers",        1,       "Number of RNN layers")
 flags.DEFINE_integer("word_hidden_size",  768,     "RNN hidden state size for word model")
 flags.DEFINE_integer("char_hidden_size",  800,     "RNN hidden state size for char model")
 flags.DEFINE_integer("softmax_samples",   1024,    "Number of classes to sample for softmax")
+flags.DEFINE_bool   ("adaptive_softmax",  False,   "Adaptive softmax with frequency-ordered clusters "
+                                                   "for training, evaluation and sampling")
+flags.DEFINE_string ("softmax_cutoffs",   "2000,10000", "Word frequency ranks where the adaptive "
+                                                   "softmax clusters start")
+flags.DEFINE_bool   ("fused_gru",         False,   "Hoist the GRU input projections out of the "
+                                                   "recurrence where inputs are known in advance "
+                                                   "(same variables)")
+flags.DEFINE_integer("recompute_every",   0,       "Keep only every these many timesteps of the "
+                                                   "teacher-forced generator and recurrent "
+                                                   "discriminator states for the backward pass and "
+                                                   "recompute the rest (0 to disable)")
+flags.DEFINE_string ("compute_dtype",     "float32", "Dtype of the model computations (float32 or "
+                                                   "float16), variables and optimizer slots stay "
+                                                   "float32")
+flags.DEFINE_float  ("loss_scale",        1.0,     "Scale the costs by this before computing "
+                                                   "gradients (and the gradients back), to keep "
+                                                   "float16 gradients from underflowing")
+flags.DEFINE_integer("eval_vocab_chunk",  8192,    "Compute the full softmax of evaluation models "
+                                                   "this many words at a time (0 to compute all "
+                                                   "logits at once)")
+flags.DEFINE_integer("eval_position_chunk", 2048,  "Positions per chunk of the chunked evaluation "
+                                                   "softmax (0 for all)")
 flags.DEFINE_bool   ("concat_inputs",     True,    "Concatenate inputs to states before "
                                                    "discriminating")
 flags.DEFINE_float  ("min_d_acc",         0.75,    "Update generator if descriminator is better "
@@ -34,6 +64,9 @@ flags.DEFINE_float  ("max_perplexity",    -1,      "Scheduler maintains perplexi
 flags.DEFINE_integer("sc_list_size",      8,       "Number of previous prints to look at in "
                                                    "scheduler")
 flags.DEFINE_float  ("sc_decay",          0.33,    "Scheduler importance decay")
+flags.DEFINE_integer("d_acc_every",       1,       "Estimate discriminator accuracy every these many "
+                                                   "steps when the scheduler trains neither GAN part "
+                                                   "(0 to disable)")
 flags.DEFINE_bool   ("d_rnn",             True,    "Recurrent discriminator")
 flags.DEFINE_bool   ("d_energy_based",    False,   "Energy-based discriminator")
 flags.DEFINE_float  ("d_word_eb_margin",  992.0,   "Margin for energy-based discriminator for word "
@@ -45,6 +78,13 @@ flags.DEFINE_integer("d_num_layers",      1,       "Number of RNN layers for dis
 flags.DEFINE_bool   ("d_rnn_bidirect",    True,    "Recurrent discriminator is bidirectional")
 flags.DEFINE_integer("d_conv_window",     5,       "Convolution window for convolution on "
                                                    "discriminative RNN's states")
+flags.DEFINE_string ("d_pooling",         "flatten", "How the recurrent discriminator's conv features "
+                                                   "are reduced over time before its output layer "
+                                                   "(flatten, max, mean or attention, the latter "
+                                                   "three work for any sentence length)")
+flags.DEFINE_bool   ("stateful",          False,   "Carry the generator state across consecutive "
+                                                   "batches (truncated BPTT over a contiguous "
+                                                   "stream, the sentence length is the unroll)")
 flags.DEFINE_integer("word_sent_length",  256,     "Maximum length of a sentence for word model")
 flags.DEFINE_integer("char_sent_length",  512,     "Maximum length of a sentence for char model")
 flags.DEFINE_float  ("max_grad_norm",     5.0,     "Gradient clipping")
@@ -56,19 +96,62 @@ flags.DEFINE_string ("g_optimizer",       "adam",  "Generator optimizer to use (
 flags.DEFINE_float  ("d_learning_rate",   1e-4,    "Optimizer initial learning rate for "
                                                    "discriminator")
 flags.DEFINE_float  ("g_learning_rate",   1e-4,    "Optimizer initial learning rate for generator")
+flags.DEFINE_bool   ("input_queue",       False,   "Feed the training batches through an in-graph "
+                                                   "queue from a background thread instead of "
+                                                   "feed_dict (only the feed copy is saved, there "
+                                                   "is still one session.run per training step)")
+flags.DEFINE_integer("num_towers",        1,       "Model replicas run in parallel on disjoint "
+                                                   "batches, averaging their gradients")
+flags.DEFINE_integer("prefetch_batches",  4,       "Number of batches to keep ready in a background "
+                                                   "thread (0 to disable)")
+flags.DEFINE_integer("shuffle_seed",      0,       "Seed for the per-epoch data shuffling")
 flags.DEFINE_integer("max_epoch",         10000,   "Maximum number of epochs to run for")
 flags.DEFINE_integer("max_steps",         9999999, "Maximum number of steps to run for")
 flags.DEFINE_integer("gen_samples",       1,       "Number of demo samples batches to generate "
                                                    "per epoch")
 flags.DEFINE_integer("gen_every",         500,     "Generate samples every these many training "
                                                    "steps (0 to disable, -1 for each epoch)")
+flags.DEFINE_integer("gen_length",        0,       "Tokens to generate per sentence with decoder.py "
+                                                   "(0 for the sentence length)")
+flags.DEFINE_float  ("temperature",       1.0,     "Sampling temperature")
+flags.DEFINE_integer("top_k",             0,       "Sample from the k most likely tokens (0 to "
+                                                   "disable)")
+flags.DEFINE_float  ("top_p",             1.0,     "Sample from the most likely tokens covering this "
+                                                   "probability mass (1 to disable)")
+flags.DEFINE_integer("top_candidates",    256,     "Most likely tokens considered per step for "
+                                                   "nucleus sampling and beam search")
+flags.DEFINE_integer("beam_size",         1,       "Beam search with this many beams per sentence "
+                                                   "(1 to sample instead)")
+flags.DEFINE_string ("prompt",            "",      "Text for decoder.py to continue")
+flags.DEFINE_integer("prompt_cache_size", 128,     "Encoded prompt states the decoder keeps")
+flags.DEFINE_string ("serve_address",     "localhost:8000", "Address for server.py to listen on, "
+                                                   "host:port or a Unix socket path")
+flags.DEFINE_float  ("batch_delay",       0.05,    "Seconds server.py waits for more requests to "
+                                                   "fill a batch")
+flags.DEFINE_string ("score_input",       "",      "Text file of sentences, one per line, to score "
+                                                   "with scorer.py")
+flags.DEFINE_string ("score_output",      "scores.txt", "File scorer.py writes the log-likelihood and "
+                                                   "number of scored tokens of each sentence to")
+flags.DEFINE_integer("score_workers",     1,       "Processes scoring with scorer.py, each with its "
+                                                   "own session")
 flags.DEFINE_integer("print_every",       50,      "Print every these many steps")
 flags.DEFINE_integer("save_every",        -1,      "Save every these many steps (0 to disable, "
                                                    "-1 for each epoch)")
 flags.DEFINE_bool   ("save_overwrite",    True,    "Overwrite the same file each time")
+flags.DEFINE_integer("keep_last",         0,       "Keep only these many most recent checkpoints "
+                                                   "and the keep_best ones (0 to keep all)")
+flags.DEFINE_integer("keep_best",         1,       "Checkpoints with the lowest validation perplexity "
+                                                   "kept besides the keep_last most recent")
+flags.DEFINE_bool   ("lean_eval",         True,    "Validate and test with a model that only builds "
+                                                   "the MLE path (no generated samples or "
+                                                   "discriminator costs)")
 flags.DEFINE_bool   ("test_validation",   True,    "Use the validation set during testing")
 flags.DEFINE_integer("validate_every",    1,       "Validate every these many epochs "
                                                    "(0 to disable)")
+flags.DEFINE_string ("bench",             "",      "Benchmark to run with benchmark.py")
+flags.DEFINE_integer("bench_steps",       20,      "Timed steps per benchmark measurement")
+flags.DEFINE_string ("graph_cache",       "",      "Directory to cache the built graphs in, keyed "
+                                                   "on the flags that shape them (empty to disable)")
 
 
 if cfg.char_model:
@@ -84,6 +167,12 @@ else:
     cfg.d_eb_margin = cfg.d_word_eb_margin
     cfg.vocab_file = Path(cfg.data_path) / cfg.word_vocab_file
 
+if cfg.compute_dtype not in ('float32', 'float16'):
+    # bfloat16 has no CPU compute kernels (matmul, tanh, ...) in this TensorFlow version
+    raise ValueError('compute_dtype must be float32 or float16')
+cfg.dtype = tf.as_dtype(cfg.compute_dtype)
+cfg.adaptive_cutoffs = [int(c) for c in cfg.softmax_cutoffs.split(',') if c]
+
 
 print('Config:')
 cfg._parse_flags()
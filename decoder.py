@@ -0,0 +1,234 @@
+import collections
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from checkpoint import resolve
+from config import cfg
+from reader import Vocab
+from rnnlm import RNNLMModel
+import utils
+
+
+class Decoder(object):
+
+    '''Generates from the trained generator one step per session.run, feeding the GRU states
+       back in. Supports temperature, top-k and nucleus (top-p) sampling and batched beam
+       search. Filtering and beam search only look at the num_candidates most likely tokens,
+       picked by a partial sort (top_k) in the graph, so the full distribution is never sorted
+       or copied out of the graph. Generation can continue a prompt: the prompt is encoded
+       once in a single run of the generator, and its state is kept in an LRU cache and fanned
+       out to all the rows.'''
+
+    def __init__(self, model, batch_size=None, num_candidates=None):
+        self.vocab = model.vocab
+        self.batch_size = batch_size or cfg.batch_size
+        if num_candidates is None:
+            num_candidates = max(cfg.top_candidates, cfg.top_k, cfg.beam_size)
+        num_candidates = min(num_candidates, len(self.vocab.vocab))
+
+        self.tokens = tf.placeholder(tf.int32, [self.batch_size], name='decoder_tokens')
+        self.state = tuple(tf.placeholder(tf.float32, [self.batch_size, 2 * cfg.hidden_size])
+                           for _ in range(cfg.num_layers))
+        self.temperature = tf.placeholder_with_default(1.0, [], name='temperature')
+        embs = model.word_embeddings(self.tokens)
+        with tf.variable_scope("Generator", reuse=True), tf.variable_scope("RNN"):
+            cell = model.rnn_cell(cfg.num_layers, cfg.hidden_size, pretanh=True)
+            output, new_state = cell(embs, tuple(utils.cast_to(s, cfg.dtype)
+                                                 for s in self.state))
+        self.new_state = tuple(utils.cast_to(s, tf.float32) for s in new_state)
+        # the generator over the whole prompt, in MLE mode
+        self.prompt = tf.placeholder(tf.int32, [1, None], name='prompt')
+        with tf.variable_scope("Generator", reuse=True):
+            cell = model.rnn_cell(cfg.num_layers, cfg.hidden_size, pretanh=True)
+            _, prompt_state = tf.nn.dynamic_rnn(cell, model.word_embeddings(self.prompt),
+                                                dtype=cfg.dtype)
+        self.prompt_state = tuple(utils.cast_to(s, tf.float32) for s in prompt_state)
+        self.prompt_cache = collections.OrderedDict()
+        logits = model.output_logits(output) / self.temperature
+        # ancestral sampling from the full distribution
+        self.sampled = tf.cast(tf.squeeze(tf.multinomial(logits, 1), [1]), tf.int32)
+        # log-probabilities of the most likely tokens, normalized over the whole vocab
+        top_logits, self.top_ids = tf.nn.top_k(logits, num_candidates)
+        self.top_logprobs = top_logits - tf.reduce_logsumexp(logits, [1], keep_dims=True)
+
+    def zero_state(self):
+        '''Initial GRU states.'''
+        return [np.zeros([self.batch_size, 2 * cfg.hidden_size], dtype=np.float32)
+                for _ in range(cfg.num_layers)]
+
+    def encode_prompt(self, session, prompt):
+        '''The state after the <sos> and all but the last token of the prompt ids, with one row
+           per layer, and the last token, which is the next input. Cached by the ids.'''
+        key = tuple(prompt)
+        if key in self.prompt_cache:
+            self.prompt_cache.move_to_end(key)
+            return self.prompt_cache[key]
+        if len(prompt) == 0:
+            state = [s[:1] for s in self.zero_state()]
+            token = self.vocab.sos_index
+        else:
+            inputs = np.array([[self.vocab.sos_index] + list(prompt[:-1])], dtype=np.int32)
+            state = session.run(self.prompt_state, {self.prompt: inputs})
+            token = prompt[-1]
+        self.prompt_cache[key] = (state, token)
+        if len(self.prompt_cache) > cfg.prompt_cache_size:
+            self.prompt_cache.popitem(last=False)
+        return state, token
+
+    def step(self, session, tokens, state, fetches, temperature=1.0):
+        '''Feed one token per row, returning the fetches and the new state.'''
+        f_dict = {self.tokens: tokens, self.temperature: temperature}
+        f_dict.update(zip(self.state, state))
+        ret = session.run(list(fetches) + list(self.new_state), f_dict)
+        return ret[:len(fetches)], ret[len(fetches):]
+
+    def sample(self, session, num_steps, temperature=1.0, top_k=0, top_p=1.0, state=None,
+               tokens=None, prompt=None):
+        '''Sample [batch_size, num_steps] tokens, by default starting a new sentence. With
+           prompt ids, every row continues the prompt.'''
+        if prompt is not None:
+            state, token = self.encode_prompt(session, prompt)
+            state = [np.repeat(s, self.batch_size, 0) for s in state]
+            tokens = np.full([self.batch_size], token, dtype=np.int32)
+        if state is None:
+            state = self.zero_state()
+        if tokens is None:
+            tokens = np.full([self.batch_size], self.vocab.sos_index, dtype=np.int32)
+        filtered = top_k > 0 or top_p < 1.0
+        if filtered:
+            fetches = [self.top_logprobs, self.top_ids]
+        else:
+            fetches = [self.sampled]
+        output = np.zeros([self.batch_size, num_steps], dtype=np.int32)
+        for t in range(num_steps):
+            ret, state = self.step(session, tokens, state, fetches, temperature)
+            if filtered:
+                tokens = self.filtered_sample(ret[0], ret[1], top_k, top_p)
+            else:
+                tokens = ret[0]
+            output[:, t] = tokens
+        return output
+
+    def filtered_sample(self, logprobs, ids, top_k, top_p):
+        '''Sample from candidates sorted by decreasing probability, keeping at most the top_k
+           most likely and the fewest that cover top_p of the probability mass.'''
+        probs = np.exp(logprobs)
+        if top_k > 0:
+            probs[:, top_k:] = 0.0
+        if top_p < 1.0:
+            # keep a candidate while the mass of the more likely ones is below top_p
+            probs[np.cumsum(probs, 1) - probs >= top_p] = 0.0
+        cumsum = np.cumsum(probs, 1)
+        threshold = np.random.uniform(size=[len(probs), 1]) * cumsum[:, -1:]
+        choice = np.argmax(threshold < cumsum, 1)
+        return ids[np.arange(len(ids)), choice]
+
+    def beam_search(self, session, num_steps, beam_size, temperature=1.0, state=None,
+                    tokens=None, prompt=None):
+        '''Beam search for batch_size // beam_size sentences at once, each using beam_size
+           rows. Returns the best [num_sentences, num_steps] tokens and their log-probabilities.
+           state and tokens, if given, are per sentence. With prompt ids, every sentence
+           continues the prompt.'''
+        check_beam_size(beam_size, self.batch_size)
+        num_sents = self.batch_size // beam_size
+        rows = num_sents * beam_size
+        if prompt is not None:
+            state, token = self.encode_prompt(session, prompt)
+            state = [np.repeat(s, num_sents, 0) for s in state]
+            tokens = np.full([num_sents], token, dtype=np.int32)
+        if state is None:
+            state = self.zero_state()
+        else:
+            state = [np.repeat(s, beam_size, 0) for s in state]
+            state = [np.concatenate([s, np.zeros([self.batch_size - rows, s.shape[1]], s.dtype)])
+                     for s in state]
+        if tokens is None:
+            tokens = np.full([self.batch_size], self.vocab.sos_index, dtype=np.int32)
+        else:
+            tokens = np.concatenate([np.repeat(tokens, beam_size),
+                                     np.zeros([self.batch_size - rows], dtype=np.int32)])
+        sents = np.arange(num_sents)[:, None]
+        # all beams start out identical, only expand the first
+        scores = np.full([num_sents, beam_size], -np.inf)
+        scores[:, 0] = 0.0
+        history = np.zeros([num_steps, num_sents, beam_size], dtype=np.int32)
+        parents = np.zeros([num_steps, num_sents, beam_size], dtype=np.int32)
+        for t in range(num_steps):
+            (logprobs, ids), state = self.step(session, tokens, state,
+                                               [self.top_logprobs, self.top_ids], temperature)
+            num_candidates = logprobs.shape[1]
+            candidates = (scores[:, :, None] + logprobs[:rows].reshape(
+                [num_sents, beam_size, num_candidates])).reshape([num_sents, -1])
+            best = np.argpartition(-candidates, beam_size - 1, 1)[:, :beam_size]
+            best = best[sents, np.argsort(-candidates[sents, best], 1)]
+            scores = candidates[sents, best]
+            parents[t] = best // num_candidates
+            history[t] = ids[:rows].reshape([num_sents, -1])[sents, best]
+            # continue each beam from the state of its parent
+            reorder = np.concatenate([(sents * beam_size + parents[t]).reshape([-1]),
+                                      np.arange(rows, self.batch_size)])
+            state = [s[reorder] for s in state]
+            tokens = np.concatenate([history[t].reshape([-1]), tokens[rows:]])
+        # follow the back pointers of the best beams
+        output = np.zeros([num_sents, num_steps], dtype=np.int32)
+        beam = np.zeros([num_sents], dtype=np.int32)
+        for t in reversed(range(num_steps)):
+            output[:, t] = history[t, sents[:, 0], beam]
+            beam = parents[t, sents[:, 0], beam]
+        return output, scores[:, 0]
+
+
+def check_beam_size(beam_size, batch_size):
+    '''Raise a ValueError unless beam_size beams of at least one sentence fit in a batch.'''
+    if not 1 <= beam_size <= batch_size:
+        raise ValueError('beam_size must be between 1 and the batch size (%d), got %d' %
+                         (batch_size, beam_size))
+
+
+def main(_):
+    check_beam_size(cfg.beam_size, cfg.batch_size)
+    vocab = Vocab()
+    vocab.load()
+
+    config_proto = tf.ConfigProto()
+    if not cfg.preallocate_gpu:
+        config_proto.gpu_options.allow_growth = True
+    with tf.Graph().as_default(), tf.Session(config=config_proto) as session:
+        with tf.variable_scope("Model") as scope:
+            model = RNNLMModel(vocab, False, False, eval_only=True)
+            scope.reuse_variables()
+            decoder = Decoder(model)
+        saver = tf.train.Saver()
+        try:
+            saver.restore(session, resolve(cfg.load_file))
+        except ValueError:
+            print("You need to provide a valid model file for decoding!")
+            sys.exit(1)
+        print("Model restored from", cfg.load_file)
+
+        num_steps = cfg.gen_length or cfg.max_sent_length
+        prompt = None
+        if cfg.prompt:
+            prompt = vocab.line_ids(cfg.prompt)
+        start_time = time.time()
+        if cfg.beam_size > 1:
+            output, scores = decoder.beam_search(session, num_steps, cfg.beam_size,
+                                                 cfg.temperature, prompt=prompt)
+            num_tokens = decoder.batch_size // cfg.beam_size * cfg.beam_size * num_steps
+        else:
+            output = decoder.sample(session, num_steps, cfg.temperature, cfg.top_k, cfg.top_p,
+                                    prompt=prompt)
+            num_tokens = output.size
+        elapsed = time.time() - start_time
+        if prompt is not None:
+            output = np.concatenate([np.tile(prompt, [len(output), 1]), output], 1)
+        utils.display_sentences(output, vocab, cfg.char_model)
+        print("Decoded %d tokens in %.2fs: %.0f tokens/sec" % (num_tokens, elapsed,
+                                                               num_tokens / elapsed))
+
+
+if __name__ == "__main__":
+    tf.app.run()
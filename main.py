@@ -1,20 +1,44 @@
 import glob
+import hashlib
+import os
+import pickle
 import sys
 import time
 
+IMPORT_START = time.time()
+
 import numpy as np
 import tensorflow as tf
 
+from checkpoint import Checkpointer, load_manifest, resolve
 from config import cfg
-from reader import Reader, Vocab
+from reader import Prefetcher, QueueFeeder, Reader, Vocab
 from rnnlm import RNNLMModel
 import utils
 
+IMPORT_TIME = time.time() - IMPORT_START
+
 
-def call_session(session, model, batch, train_d=False, train_g=False):
-    '''Use the session to run the model on the batch data.'''
-    f_dict = {model.data: batch}
-    ops = [model.nll, model.mle_cost, model.d_cost, model.g_cost]
+def call_session(session, model, batch, train_d=False, train_g=False, eval_d=True, state=None):
+    '''Use the session to run the model on the batch data. The free-running generator and the
+       discriminator only run when training either of them or with eval_d, otherwise d_cost
+       and g_cost are None. In stateful mode, batch has an extra column of next tokens and the
+       final generator state is returned last. A model with an input queue dequeues the batch
+       in the graph, it isn't fed.'''
+    if model.enqueue_op is not None:
+        f_dict = {}
+    elif cfg.stateful:
+        f_dict = {model.data: batch[:, :-1], model.next_tokens: batch[:, -1]}
+    else:
+        f_dict = {model.data: batch}
+    if cfg.stateful:
+        f_dict.update(zip(model.initial_state, state))
+    ops = [model.nll, model.mle_cost]
+    run_gan = train_d or train_g or eval_d
+    if run_gan:
+        ops.extend([model.d_cost, model.g_cost])
+    if cfg.stateful:
+        ops.extend(model.final_state)
     # training ops are tf.no_op() for a non-training model
     train_ops = [model.mle_train_op]
     if train_d:
@@ -22,28 +46,46 @@ def call_session(session, model, batch, train_d=False, train_g=False):
     if train_g:
         train_ops.append(model.g_train_op)
     ops.extend(train_ops)
-    return session.run(ops, f_dict)[:-len(train_ops)]
+    ret = session.run(ops, f_dict)[:-len(train_ops)]
+    if not run_gan:
+        ret[2:2] = [None, None]
+    if cfg.stateful:
+        return ret[:4] + [ret[4:]]
+    return ret
 
 
 def generate_sentences(session, model, vocab):
-    '''Generate sentences using the generator.'''
-    f_dict = {model.data: np.zeros([cfg.batch_size, cfg.max_sent_length], dtype=np.int32)}
+    '''Generate sentences using the generator, if the model has one.'''
+    if model.generated is None:
+        return
+    f_dict = {model.data: np.zeros(model.data.get_shape().as_list(), dtype=np.int32)}
     utils.display_sentences(session.run(model.generated, f_dict), vocab, cfg.char_model)
 
 
-def save_model(session, saver, perp, cur_iters):
-    '''Save model file.'''
+def save_model(checkpointer, perp, cur_iters, train_state=None):
+    '''Save model file, and the training state to resume from next to it, in the background.'''
     save_file = cfg.save_file
     if not cfg.save_overwrite:
         save_file = save_file + '.' + str(cur_iters)
     print("Saving model (epoch perplexity: %.3f) ..." % perp)
-    save_file = saver.save(session, save_file)
-    print("Saved to", save_file)
+    blocked = checkpointer.save(save_file, train_state, perp)
+    print("Training blocked for %.2fs by the save" % blocked)
 
 
-def run_epoch(epoch, session, model, batch_loader, vocab, saver, steps, max_steps, scheduler,
-              use_gan, gen_every):
-    '''Runs the model on the given data for an epoch.'''
+def load_train_state(load_file):
+    '''Load the training state saved next to a model file, if any.'''
+    try:
+        with open(resolve(load_file) + '.state', 'rb') as f:
+            return pickle.load(f)
+    except IOError:
+        return None
+
+
+def run_epoch(epoch, session, model, batch_loader, vocab, checkpointer, steps, max_steps,
+              scheduler, use_gan, gen_every, reader=None, gen_state=None):
+    '''Runs the model on the given data for an epoch. For training, reader is the source of
+       batch_loader, whose position is saved with the model, and gen_state the carried state
+       to resume from in stateful mode.'''
     start_time = time.time()
     nlls = 0.0
     mle_costs = 0.0
@@ -51,6 +93,7 @@ def run_epoch(epoch, session, model, batch_loader, vocab, saver, steps, max_step
     shortterm_nlls = 0.0
     shortterm_mle_costs = 0.0
     shortterm_d_costs = 0.0
+    shortterm_d_evals = 0
     shortterm_g_costs = 0.0
     shortterm_iters = 0
     shortterm_steps = 0
@@ -58,132 +101,316 @@ def run_epoch(epoch, session, model, batch_loader, vocab, saver, steps, max_step
     d_steps = 0
     update_d = False
     update_g = False
+    state = gen_state
+    if cfg.stateful and state is None:
+        # every epoch starts from a zero state
+        state = [np.zeros(s.get_shape().as_list(), dtype=np.float32)
+                 for s in model.initial_state]
+    if model.enqueue_op is not None:
+        # the batches go through the input queue, the loop only sees them for bookkeeping
+        batch_loader = QueueFeeder(session, model, batch_loader)
+    elif cfg.prefetch_batches > 0:
+        batch_loader = Prefetcher(batch_loader, cfg.prefetch_batches)
+    prefetching = model.enqueue_op is not None or cfg.prefetch_batches > 0
+    if prefetching:
+        epoch_start_time = start_time
+        last_wait_time = 0.0
 
-    for step, batch in enumerate(batch_loader):
-        cur_iters = steps + step
-        if scheduler is not None:
-            update_d = use_gan and scheduler.update_d()
-            update_g = use_gan and scheduler.update_g()
-        if update_d:
-            d_steps += 1
-        if update_g:
-            g_steps += 1
-
-        nll, mle_cost, d_cost, g_cost = call_session(session, model, batch, train_d=update_d,
-                                                     train_g=update_g)
-        if scheduler is not None:
-            if cfg.d_energy_based:
-                d_acc = -1.0
-            else:
-                d_acc = np.exp(-d_cost)
-            scheduler.add_d_acc(d_acc)
+    step = -1
+    finished = False  # whether the loop went through all the batches
+    pending_save = None  # (perplexity, cur_iters, train_state) of a save due at the last step
+    try:
+        for step, batch in enumerate(batch_loader):
+            if pending_save is not None:
+                # the epoch goes on, so it is resumed from this batch
+                save_model(checkpointer, *pending_save)
+                pending_save = None
+            cur_iters = steps + step
+            if scheduler is not None:
+                update_d = use_gan and scheduler.update_d()
+                update_g = use_gan and scheduler.update_g()
+            if update_d:
+                d_steps += 1
+            if update_g:
+                g_steps += 1
 
-        if cfg.char_model:
-            n_words = (np.sum(batch == vocab.vocab_lookup[' ']) // cfg.batch_size) + 1
-        else:
-            n_words = cfg.max_sent_length
-        if scheduler is not None:
-            scheduler.add_perp(np.exp(nll / n_words))
-
-        nlls += nll
-        mle_costs += mle_cost
-        shortterm_nlls += nll
-        shortterm_mle_costs += mle_cost
-        shortterm_d_costs += d_cost
-        shortterm_g_costs += g_cost
-        iters += n_words
-        shortterm_iters += n_words
-        shortterm_steps += 1
-
-        if step % cfg.print_every == 0:
-            avg_nll = shortterm_nlls / shortterm_iters
-            avg_mle_cost = shortterm_mle_costs / shortterm_steps
-            avg_d_cost = shortterm_d_costs / shortterm_steps
-            if cfg.d_energy_based:
-                d_acc = -1.0
+            # when neither GAN part is trained, only estimate d_acc every d_acc_every steps
+            eval_d = use_gan and cfg.d_acc_every > 0 and step % cfg.d_acc_every == 0
+            if cfg.stateful:
+                nll, mle_cost, d_cost, g_cost, state = call_session(session, model, batch,
+                                                                    train_d=update_d,
+                                                                    train_g=update_g,
+                                                                    eval_d=eval_d, state=state)
+                batch = batch[:, :-1]
             else:
-                d_acc = np.exp(-avg_d_cost)
-            if g_steps:
-                avg_g_cost = shortterm_g_costs / g_steps
+                nll, mle_cost, d_cost, g_cost = call_session(session, model, batch,
+                                                             train_d=update_d, train_g=update_g,
+                                                             eval_d=eval_d)
+            if scheduler is not None and d_cost is not None:
+                if cfg.d_energy_based:
+                    d_acc = -1.0
+                else:
+                    d_acc = np.exp(-d_cost)
+                scheduler.add_d_acc(d_acc)
+
+            if cfg.char_model:
+                n_words = (np.sum(batch == vocab.vocab_lookup[' ']) // len(batch)) + 1
             else:
-                avg_g_cost = -1.0
-            print("%d: %d (%d)  perplexity: %.3f  mle_loss: %.4f  mle_cost: %.4f  d_cost: %.4f  "
-                  "g_cost: %.4f  d_acc: %.4f  speed: %.0f wps  D:%d G:%d" % (epoch + 1, step,
-                  cur_iters, np.exp(avg_nll), avg_nll, avg_mle_cost, avg_d_cost, avg_g_cost, d_acc,
-                  shortterm_iters * cfg.batch_size / (time.time() - start_time), d_steps, g_steps))
-
-            shortterm_nlls = 0.0
-            shortterm_mle_costs = 0.0
-            shortterm_d_costs = 0.0
-            shortterm_g_costs = 0.0
-            shortterm_iters = 0
-            shortterm_steps = 0
-            g_steps = 0
-            d_steps = 0
-            start_time = time.time()
+                n_words = cfg.max_sent_length
+            if scheduler is not None:
+                scheduler.add_perp(np.exp(nll / n_words))
+
+            nlls += nll
+            mle_costs += mle_cost
+            shortterm_nlls += nll
+            shortterm_mle_costs += mle_cost
+            if d_cost is not None:
+                shortterm_d_costs += d_cost
+                shortterm_d_evals += 1
+            if update_g:
+                shortterm_g_costs += g_cost
+            iters += n_words
+            shortterm_iters += n_words
+            shortterm_steps += 1
 
-        if gen_every > 0 and (step + 1) % gen_every == 0:
-            for _ in range(cfg.gen_samples):
-                generate_sentences(session, model, vocab)
+            if step % cfg.print_every == 0:
+                avg_nll = shortterm_nlls / shortterm_iters
+                avg_mle_cost = shortterm_mle_costs / shortterm_steps
+                if shortterm_d_evals:
+                    avg_d_cost = shortterm_d_costs / shortterm_d_evals
+                else:
+                    avg_d_cost = -1.0
+                if cfg.d_energy_based or not shortterm_d_evals:
+                    d_acc = -1.0
+                else:
+                    d_acc = np.exp(-avg_d_cost)
+                if g_steps:
+                    avg_g_cost = shortterm_g_costs / g_steps
+                else:
+                    avg_g_cost = -1.0
+                status = ("%d: %d (%d)  perplexity: %.3f  mle_loss: %.4f  mle_cost: %.4f  "
+                          "d_cost: %.4f  g_cost: %.4f  d_acc: %.4f  speed: %.0f wps  D:%d G:%d" %
+                          (epoch + 1, step, cur_iters, np.exp(avg_nll), avg_nll, avg_mle_cost,
+                           avg_d_cost, avg_g_cost, d_acc,
+                           shortterm_iters * len(batch) / (time.time() - start_time), d_steps,
+                           g_steps))
+                if prefetching:
+                    wait_time = batch_loader.wait_time - last_wait_time
+                    status += "  data wait: %.1f%%" % (100 * wait_time / (time.time() - start_time))
+                    last_wait_time = batch_loader.wait_time
+                print(status)
 
-        if saver is not None and cur_iters and cfg.save_every > 0 and \
-                cur_iters % cfg.save_every == 0:
-            save_model(session, saver, np.exp(nlls / iters), cur_iters)
+                shortterm_nlls = 0.0
+                shortterm_mle_costs = 0.0
+                shortterm_d_costs = 0.0
+                shortterm_d_evals = 0
+                shortterm_g_costs = 0.0
+                shortterm_iters = 0
+                shortterm_steps = 0
+                g_steps = 0
+                d_steps = 0
+                start_time = time.time()
 
-        if max_steps > 0 and cur_iters >= max_steps:
-            break
+            if gen_every > 0 and (step + 1) % gen_every == 0:
+                for _ in range(cfg.gen_samples):
+                    generate_sentences(session, model, vocab)
+
+            if checkpointer is not None and cur_iters and cfg.save_every > 0 and \
+                    cur_iters % cfg.save_every == 0:
+                # saved once it is known whether this was the last batch of the epoch
+                train_state = {'epoch': epoch, 'reader': reader.position(step + 1),
+                               'scheduler': scheduler.history(), 'gen_state': state}
+                pending_save = (np.exp(nlls / iters), cur_iters, train_state)
+
+            if max_steps > 0 and cur_iters >= max_steps:
+                break
+        else:
+            finished = True
+            if pending_save is not None:
+                # there are no batches left to resume from, resume with the next epoch instead
+                pending_save[2].update(epoch=epoch + 1, reader=None, gen_state=None)
+    finally:
+        if prefetching:
+            # also stops the background thread when a step fails
+            batch_loader.close()
+    if pending_save is not None:
+        save_model(checkpointer, *pending_save)
+
+    if prefetching:
+        print("Waited %.1fs for data (%.1f%% of the epoch)" % (batch_loader.wait_time,
+              100 * batch_loader.wait_time / (time.time() - epoch_start_time)))
 
     if gen_every < 0:
         for _ in range(cfg.gen_samples):
             generate_sentences(session, model, vocab)
 
-    perp = np.exp(nlls / iters)
-    cur_iters = steps + step
-    if saver is not None and cfg.save_every < 0:
-        save_model(session, saver, perp, cur_iters)
+    if iters:
+        perp = np.exp(nlls / iters)
+    else:
+        perp = float('nan')  # no batches, e.g. resuming at the end of the data
+    cur_iters = steps + max(step, 0)
+    if checkpointer is not None and cfg.save_every < 0:
+        if finished:
+            train_state = {'epoch': epoch + 1, 'reader': None,
+                           'scheduler': scheduler.history(), 'gen_state': None}
+        else:
+            # stopped by max_steps, the rest of the epoch is resumed
+            train_state = {'epoch': epoch, 'reader': reader.position(step + 1),
+                           'scheduler': scheduler.history(), 'gen_state': state}
+        save_model(checkpointer, perp, cur_iters, train_state)
     return perp, cur_iters
 
 
+# flags that don't change the graph, left out of the graph cache key
+RUNTIME_FLAGS = {
+    'data_path', 'save_file', 'load_file', 'train_files', 'word_vocab_file', 'char_vocab_file',
+    'binary_corpus', 'cache_corpus', 'vocab_workers', 'preallocate_gpu', 'min_d_acc',
+    'max_d_acc', 'max_perplexity', 'sc_list_size', 'sc_decay', 'd_acc_every', 'd_learning_rate',
+    'g_learning_rate', 'prefetch_batches', 'shuffle_seed', 'max_epoch', 'max_steps',
+    'gen_samples', 'gen_every', 'gen_length', 'temperature', 'top_k', 'top_p', 'top_candidates',
+    'beam_size', 'prompt', 'prompt_cache_size', 'serve_address', 'batch_delay', 'score_input',
+    'score_output', 'score_workers', 'print_every', 'save_every', 'save_overwrite', 'keep_last',
+    'keep_best', 'test_validation', 'validate_every', 'bench', 'bench_steps', 'graph_cache',
+}
+
+# RNNLMModel attributes used by the training loop, kept in graph collections
+MODEL_TENSORS = ['data', 'next_tokens', 'nll', 'mle_cost', 'd_cost', 'g_cost', 'losses',
+                 'generated', 'mle_train_op', 'd_train_op', 'g_train_op', 'global_step',
+                 'enqueue_batch', 'enqueue_op', 'drain_op']
+MODEL_TUPLES = ['initial_state', 'final_state']
+
+
+class ModelHandles(object):
+
+    '''The tensors and ops of a model that the training loop uses, looked up from the graph
+       collections so that they are also available from an imported graph.'''
+
+    def __init__(self, name):
+        for attr in MODEL_TENSORS:
+            values = tf.get_collection('%s/%s' % (name, attr))
+            setattr(self, attr, values[0] if values else None)
+        for attr in MODEL_TUPLES:
+            setattr(self, attr, tuple(tf.get_collection('%s/%s' % (name, attr))) or None)
+        self.use_gan = bool(tf.get_collection('%s/use_gan' % name)[0])
+
+    @staticmethod
+    def add_to_collections(name, model):
+        '''Record the model's tensors and ops in the collections of its graph.'''
+        for attr in MODEL_TENSORS:
+            value = getattr(model, attr, None)
+            if value is not None:
+                tf.add_to_collection('%s/%s' % (name, attr), value)
+        for attr in MODEL_TUPLES:
+            for value in getattr(model, attr, None) or ():
+                tf.add_to_collection('%s/%s' % (name, attr), value)
+        tf.add_to_collection('%s/use_gan' % name, int(model.use_gan))
+
+
+def build_graph(vocab):
+    '''Build the models of the run mode in the default graph, returning the saver.'''
+    with tf.variable_scope("Model") as scope:
+        if cfg.training:
+            with tf.variable_scope("LR"):
+                g_lr = tf.get_variable("g_lr", shape=[], initializer=tf.zeros_initializer,
+                                       trainable=False)
+                d_lr = tf.get_variable("d_lr", shape=[], initializer=tf.zeros_initializer,
+                                       trainable=False)
+            tf.add_to_collection('g_lr', g_lr.op)
+            tf.add_to_collection('d_lr', d_lr.op)
+            g_optimizer = utils.get_optimizer(g_lr, cfg.g_optimizer)
+            d_optimizer = utils.get_optimizer(d_lr, cfg.d_optimizer)
+            model = RNNLMModel(vocab, True, cfg.use_gan, g_optimizer=g_optimizer,
+                               d_optimizer=d_optimizer, input_queue=cfg.input_queue,
+                               num_towers=cfg.num_towers)
+            ModelHandles.add_to_collections('train', model)
+            scope.reuse_variables()
+            eval_model = RNNLMModel(vocab, False, cfg.use_gan, eval_only=cfg.lean_eval)
+            ModelHandles.add_to_collections('eval', eval_model)
+        else:
+            test_model = RNNLMModel(vocab, False, cfg.use_gan, eval_only=cfg.lean_eval)
+            ModelHandles.add_to_collections('test', test_model)
+    return tf.train.Saver(max_to_keep=None)
+
+
+def graph_cache_file(vocab):
+    '''The meta graph file for the flags that shape the graph and the vocab, or None if graph
+       caching is disabled.'''
+    if not cfg.graph_cache:
+        return None
+    flags = sorted((k, v) for k, v in cfg.__dict__['__flags'].items() if k not in RUNTIME_FLAGS)
+    if cfg.input_queue:
+        # the capacity of the input queue
+        flags.append(('prefetch_batches', cfg.prefetch_batches))
+    key = hashlib.md5(repr(flags).encode('utf-8'))
+    key.update(repr((len(vocab.vocab), vocab.sos_index, vocab.unk_index)).encode('utf-8'))
+    if vocab.counts is not None:
+        key.update(np.ascontiguousarray(vocab.counts).tobytes())
+    mode = 'train' if cfg.training else 'test'
+    return os.path.join(cfg.graph_cache, '%s-%s.meta' % (mode, key.hexdigest()))
+
+
+def load_graph(vocab):
+    '''Import the cached graph for this configuration into the default graph, or build it
+       (and cache it). Returns the saver and whether the graph was imported.'''
+    cache_file = graph_cache_file(vocab)
+    if cache_file is not None and os.path.exists(cache_file):
+        return tf.train.import_meta_graph(cache_file), True
+    saver = build_graph(vocab)
+    if cache_file is not None:
+        os.makedirs(cfg.graph_cache, exist_ok=True)
+        saver.export_meta_graph(cache_file + '.tmp')
+        os.replace(cache_file + '.tmp', cache_file)
+    return saver, False
+
+
 def main(_):
+    timings = [('imports', IMPORT_TIME)]
+    start_time = time.time()
     vocab = Vocab()
-    vocab.load_from_pickle()
+    vocab.load()
     reader = Reader(vocab)
+    timings.append(('vocab load', time.time() - start_time))
 
     config_proto = tf.ConfigProto()
     if not cfg.preallocate_gpu:
         config_proto.gpu_options.allow_growth = True
     if not cfg.training and not cfg.save_overwrite:
-        load_files = [f for f in glob.glob(cfg.load_file + '.*') if not f.endswith('meta')]
+        # numbered model files, saved directly or listed in the manifest
+        load_files = set(glob.glob(cfg.load_file + '.*'))
+        load_files.update(e['path'] for e in load_manifest(cfg.load_file))
+        load_files = [f for f in load_files if f[len(cfg.load_file)+1:].isdigit()]
         load_files = sorted(load_files, key=lambda x: float(x[len(cfg.load_file)+1:]))
     else:
         load_files = [cfg.load_file]
     if not cfg.training:
         test_perps = []
-    for load_file in load_files:
-        with tf.Graph().as_default(), tf.Session(config=config_proto) as session:
-            with tf.variable_scope("Model") as scope:
-                if cfg.training:
-                    with tf.variable_scope("LR"):
-                        g_lr = tf.get_variable("g_lr", shape=[], initializer=tf.zeros_initializer,
-                                               trainable=False)
-                        d_lr = tf.get_variable("d_lr", shape=[], initializer=tf.zeros_initializer,
-                                               trainable=False)
-                    g_optimizer = utils.get_optimizer(g_lr, cfg.g_optimizer)
-                    d_optimizer = utils.get_optimizer(d_lr, cfg.d_optimizer)
-                    model = RNNLMModel(vocab, True, cfg.use_gan, g_optimizer=g_optimizer,
-                                       d_optimizer=d_optimizer)
-                    scope.reuse_variables()
-                    eval_model = RNNLMModel(vocab, False, cfg.use_gan)
-                else:
-                    test_model = RNNLMModel(vocab, False, cfg.use_gan)
-            saver = tf.train.Saver(max_to_keep=None)
+    with tf.Graph().as_default(), tf.Session(config=config_proto) as session:
+        start_time = time.time()
+        # the graph is built (or imported) once, and every checkpoint is restored into it
+        saver, imported = load_graph(vocab)
+        timings.append(('graph import' if imported else 'graph build', time.time() - start_time))
+        if cfg.training:
+            model = ModelHandles('train')
+            eval_model = ModelHandles('eval')
+            g_lr = tf.get_collection('g_lr')[0].outputs[0]
+            d_lr = tf.get_collection('d_lr')[0].outputs[0]
+            if cfg.save_every != 0:
+                checkpointer = Checkpointer(session, cfg.save_file, cfg.keep_last, cfg.keep_best)
+            else:
+                checkpointer = None
+        else:
+            test_model = ModelHandles('test')
+        for load_file in load_files:
+            start_time = time.time()
             steps = 0
             try:
                 # try to restore a saved model file
-                saver.restore(session, load_file)
+                saver.restore(session, resolve(load_file))
                 print("\nModel restored from", load_file)
-                with tf.variable_scope("Model", reuse=True):
-                    steps = session.run(tf.get_variable("GlobalMLE/global_step"))
+                if cfg.training:
+                    steps = session.run(model.global_step)
+                else:
+                    steps = session.run(test_model.global_step)
                 print('Global step', steps)
             except ValueError:
                 if cfg.training:
@@ -192,6 +419,13 @@ def main(_):
                 else:
                     print("You need to provide a valid model file for testing!")
                     sys.exit(1)
+            if timings is not None:
+                timings.append(('restore', time.time() - start_time))
+                print('Startup: ' + ', '.join('%s %.2fs' % t for t in timings) +
+                      ', total %.2fs' % sum(t for _, t in timings))
+                timings = None
+            else:
+                print('Restored in %.2fs' % (time.time() - start_time))
 
             if cfg.training:
                 train_perps = []
@@ -201,24 +435,48 @@ def main(_):
                 energy_based = cfg.d_rnn and cfg.d_energy_based
                 scheduler = utils.Scheduler(cfg.min_d_acc, cfg.max_d_acc, cfg.max_perplexity,
                                             cfg.sc_list_size, cfg.sc_decay, eb=energy_based)
-                for i in range(cfg.max_epoch):
+                start_epoch = 0
+                position = None
+                gen_state = None
+                train_state = load_train_state(load_file)
+                if train_state is not None:
+                    # continue from where the saved model left off in the data
+                    start_epoch = train_state['epoch']
+                    position = train_state['reader']
+                    gen_state = train_state['gen_state']
+                    scheduler.restore(train_state['scheduler'])
+                    print('Resuming epoch %d' % (start_epoch + 1))
+                for i in range(start_epoch, cfg.max_epoch):
                     print("\nEpoch: %d" % (i + 1))
-                    perplexity, steps = run_epoch(i, session, model, reader.training(), vocab,
-                                                  saver, steps, cfg.max_steps, scheduler,
-                                                  cfg.use_gan, cfg.gen_every)
+                    batches = reader.training(i, position, cfg.num_towers)
+                    if checkpointer is not None:
+                        checkpointer.last_save = None
+                    perplexity, steps = run_epoch(i, session, model, batches, vocab,
+                                                  checkpointer, steps, cfg.max_steps, scheduler,
+                                                  cfg.use_gan, cfg.gen_every, reader=reader,
+                                                  gen_state=gen_state)
+                    position = None
+                    gen_state = None
                     print("Epoch: %d Train Perplexity: %.3f" % (i + 1, perplexity))
                     train_perps.append(perplexity)
                     if cfg.validate_every > 0 and (i + 1) % cfg.validate_every == 0:
                         perplexity, _ = run_epoch(i, session, eval_model, reader.validation(),
-                                                  vocab, None, 0, -1, None, cfg.use_gan, -1)
+                                                  vocab, None, 0, -1, None, eval_model.use_gan,
+                                                  -1)
                         print("Epoch: %d Validation Perplexity: %.3f" % (i + 1, perplexity))
                         valid_perps.append(perplexity)
+                        if checkpointer is not None and checkpointer.last_save is not None:
+                            # the last checkpoint of the epoch that was validated
+                            checkpointer.validated(checkpointer.last_save, perplexity)
                     else:
                         valid_perps.append(None)
                     print('Train:', train_perps)
                     print('Valid:', valid_perps)
                     if steps >= cfg.max_steps:
                         break
+                if checkpointer is not None:
+                    # the last checkpoint is still being written
+                    checkpointer.wait()
             else:
                 if cfg.test_validation:
                     batch_loader = reader.validation()
@@ -226,11 +484,10 @@ def main(_):
                     batch_loader = reader.testing()
                 print('\nTesting')
                 perplexity, _ = run_epoch(0, session, test_model, batch_loader, vocab, None, 0,
-                                          cfg.max_steps, None, cfg.use_gan, -1)
+                                          cfg.max_steps, None, test_model.use_gan, -1)
                 print("Test Perplexity: %.3f" % perplexity)
                 test_perps.append((int(steps), perplexity))
                 print('Test:', test_perps)
-                test_model = None
 
 
 if __name__ == "__main__":
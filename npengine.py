@@ -0,0 +1,277 @@
+'''NumPy-only inference with the generator of a trained model, for short-lived generation and
+scoring jobs that can't afford importing TensorFlow and restoring a graph.
+
+The generator variables are exported from a checkpoint once (this step uses TensorFlow):
+    python npengine.py export models/recent.dat models/recent.npz
+and then used without it:
+    python npengine.py generate models/recent.npz data_ptb/wvocab.vocab -n 10
+    python npengine.py score models/recent.npz data_ptb/wvocab.vocab sentences.txt scores.txt
+
+The forward pass is that of the pretanh GRU layers of rnncell.MultiRNNCell and of the full
+softmax of RNNLMModel, in float32. The adaptive softmax isn't supported.'''
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+import vocabfile
+from wordnorm import fix_word
+
+
+EMBEDDING = 'Model/Embeddings/word_embedding'
+SOFTMAX = 'Model/MLE_Softmax/%s'
+GRU = 'Model/Generator/RNN/MultiRNNCell/Layer%d/GRUCell/%s/Linear/%s'
+
+
+def export(checkpoint, path):
+    '''Write the generator variables of a checkpoint to an .npz file.'''
+    import tensorflow as tf  # only needed to read the checkpoint
+    from checkpoint import resolve
+    reader = tf.train.NewCheckpointReader(resolve(checkpoint))
+    names = reader.get_variable_to_shape_map()
+    if SOFTMAX % 'W' not in names:
+        raise ValueError('%s has no full softmax variables (adaptive softmax?)' % checkpoint)
+    weights = {'embedding': reader.get_tensor(EMBEDDING),
+               'softmax_w': reader.get_tensor(SOFTMAX % 'W'),
+               'softmax_b': reader.get_tensor(SOFTMAX % 'b')}
+    layer = 0
+    while GRU % (layer, 'Gates', 'Matrix') in names:
+        for part in ['Gates', 'Candidate']:
+            for var in ['Matrix', 'Bias']:
+                weights['layer%d_%s_%s' % (layer, part.lower(), var.lower())] = \
+                    reader.get_tensor(GRU % (layer, part, var))
+        layer += 1
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, **{k: np.asarray(v, dtype=np.float32) for k, v in weights.items()})
+    os.replace(path + '.tmp', path)
+    return layer
+
+
+class Engine(object):
+
+    '''The generator forward pass on exported weights. States are the pretanh GRU states,
+       [batch, 2 * hidden_size] per layer, as in the TensorFlow models.'''
+
+    def __init__(self, weights):
+        self.embedding = weights['embedding']
+        self.softmax_w = weights['softmax_w']
+        self.softmax_b = weights['softmax_b']
+        self.hidden_size = self.softmax_w.shape[1]
+        self.layers = []
+        layer = 0
+        while 'layer%d_gates_matrix' % layer in weights:
+            gates_matrix = weights['layer%d_gates_matrix' % layer]
+            candidate_matrix = weights['layer%d_candidate_matrix' % layer]
+            input_size = gates_matrix.shape[0] - self.hidden_size
+            # the input halves of both matmuls in one, as in rnncell.hoisted_rnn
+            input_matrix = np.concatenate([gates_matrix[:input_size],
+                                           candidate_matrix[:input_size]], 1)
+            input_bias = np.concatenate([weights['layer%d_gates_bias' % layer],
+                                         weights['layer%d_candidate_bias' % layer]])
+            self.layers.append((input_matrix, input_bias, gates_matrix[input_size:],
+                                candidate_matrix[input_size:]))
+            layer += 1
+
+    @classmethod
+    def load(cls, path):
+        '''Load the weights exported to an .npz file.'''
+        with np.load(path) as weights:
+            return cls({k: weights[k] for k in weights.files})
+
+    def zero_state(self, batch_size):
+        '''Initial GRU states.'''
+        return [np.zeros([batch_size, 2 * self.hidden_size], dtype=np.float32)
+                for _ in self.layers]
+
+    def _gru(self, projected, state, gates_matrix, candidate_matrix):
+        '''One GRU step on inputs projected by the input halves of the matmuls.'''
+        num_units = self.hidden_size
+        h = state[:, :num_units]
+        gates = projected[:, :2 * num_units] + np.dot(h, gates_matrix)
+        gates = 1.0 / (1.0 + np.exp(-gates))
+        r, u = gates[:, :num_units], gates[:, num_units:]
+        preact = projected[:, 2 * num_units:] + np.dot(r * h, candidate_matrix)
+        new_h = u * h + (1 - u) * np.tanh(preact)
+        return np.concatenate([new_h, preact], 1)
+
+    def step(self, tokens, state):
+        '''Feed one token per row, returning the top layer output and the new state.'''
+        inputs = self.embedding[tokens]
+        new_state = []
+        for (input_matrix, input_bias, gates_matrix, candidate_matrix), s in zip(self.layers,
+                                                                                  state):
+            s = self._gru(np.dot(inputs, input_matrix) + input_bias, s, gates_matrix,
+                          candidate_matrix)
+            new_state.append(s)
+            inputs = s[:, :self.hidden_size]
+        return inputs, new_state
+
+    def run(self, data, state=None):
+        '''Run [batch, time] tokens through the layers, one layer at a time with the input
+           projections of all timesteps in a single matmul. Returns the [batch, time,
+           hidden_size] top layer outputs and the final state.'''
+        batch_size, num_steps = data.shape
+        if state is None:
+            state = self.zero_state(batch_size)
+        inputs = self.embedding[data]
+        final_state = []
+        for (input_matrix, input_bias, gates_matrix, candidate_matrix), s in zip(self.layers,
+                                                                                  state):
+            projected = (np.dot(inputs.reshape([batch_size * num_steps, -1]), input_matrix) +
+                         input_bias).reshape([batch_size, num_steps, -1])
+            outputs = np.empty([batch_size, num_steps, self.hidden_size], dtype=np.float32)
+            for t in range(num_steps):
+                s = self._gru(projected[:, t], s, gates_matrix, candidate_matrix)
+                outputs[:, t] = s[:, :self.hidden_size]
+            final_state.append(s)
+            inputs = outputs
+        return inputs, final_state
+
+    def log_probs(self, outputs, temperature=1.0):
+        '''[positions, vocab_size] log-probabilities of [positions, hidden_size] outputs.'''
+        logits = np.dot(outputs, self.softmax_w.T) + self.softmax_b
+        if temperature != 1.0:
+            logits /= temperature
+        logits -= np.max(logits, 1, keepdims=True)
+        return logits - np.log(np.sum(np.exp(logits), 1, keepdims=True))
+
+    def losses(self, data, unk_index, next_tokens=None, state=None, chunk_size=1024):
+        '''Per-position negative log-likelihoods of [batch, time] tokens, like
+           RNNLMModel.losses: the targets are the tokens shifted left followed by next_tokens
+           (zeros by default), and <unk> targets have no loss.'''
+        outputs, _ = self.run(data, state)
+        if next_tokens is None:
+            next_tokens = np.zeros([len(data)], dtype=data.dtype)
+        targets = np.concatenate([data[:, 1:], next_tokens[:, None]], 1).reshape([-1])
+        outputs = outputs.reshape([len(targets), -1])
+        losses = np.empty([len(targets)], dtype=np.float32)
+        # a chunk of positions at a time keeps the logits small
+        for start in range(0, len(targets), chunk_size):
+            log_probs = self.log_probs(outputs[start:start + chunk_size])
+            chunk_targets = targets[start:start + chunk_size]
+            losses[start:start + chunk_size] = -log_probs[np.arange(len(chunk_targets)),
+                                                          chunk_targets]
+        losses[targets == unk_index] = 0.0
+        return losses.reshape(data.shape)
+
+    def sample(self, batch_size, num_steps, sos_index, temperature=1.0, rng=np.random):
+        '''Sample [batch_size, num_steps] tokens starting a new sentence.'''
+        tokens = np.full([batch_size], sos_index, dtype=np.int32)
+        state = self.zero_state(batch_size)
+        output = np.zeros([batch_size, num_steps], dtype=np.int32)
+        for t in range(num_steps):
+            outputs, state = self.step(tokens, state)
+            probs = np.exp(self.log_probs(outputs, temperature))
+            cumsum = np.cumsum(probs, 1)
+            threshold = rng.uniform(size=[batch_size, 1]) * cumsum[:, -1:]
+            tokens = np.argmax(threshold < cumsum, 1).astype(np.int32)
+            output[:, t] = tokens
+        return output
+
+
+class Vocab(object):
+
+    '''The compact vocab file (see vocabfile), with the tokenization of reader.Vocab.'''
+
+    def __init__(self, path, char_model=False):
+        self.vocab, self.vocab_lookup, _ = vocabfile.load(path)
+        self.sos_index = self.vocab_lookup.get('<sos>')
+        self.unk_index = self.vocab_lookup.get('<unk>')
+        self.char_model = char_model
+
+    def line_ids(self, line):
+        '''Tokenize a line of text into an int32 array of ids.'''
+        words = line.split()
+        if self.char_model:
+            tokens = []
+            for i, word in enumerate(words):
+                if i:
+                    tokens.append(' ')
+                tokens.extend([word] if word == '<unk>' else word)
+        else:
+            tokens = [w if w == '<unk>' else fix_word(w) for w in words]
+        return np.array([self.vocab_lookup.get(t, self.unk_index) for t in tokens if t],
+                        dtype=np.int32)
+
+    def text(self, sent):
+        '''Text of a sentence of ids, up to the <sos> that ends it.'''
+        ends = np.flatnonzero(sent == self.sos_index)
+        if len(ends):
+            sent = sent[:ends[0]]
+        return ('' if self.char_model else ' ').join(self.vocab[i] for i in sent)
+
+
+def score_file(engine, vocab, f_in, f_out, batch_size, max_length):
+    '''Write the log-likelihood and number of scored tokens of each line of f_in, as
+       scorer.Scorer does, returning the number of lines.'''
+    count = 0
+    while True:
+        sents = [vocab.line_ids(line)[:max_length - 1] for _, line in zip(range(batch_size),
+                                                                          f_in)]
+        if not sents:
+            return count
+        lengths = np.array([len(sent) + 1 for sent in sents])
+        data = np.full([len(sents), max(lengths)], vocab.sos_index, dtype=np.int32)
+        for i, sent in enumerate(sents):
+            data[i, 1:len(sent) + 1] = sent
+        losses = engine.losses(data, vocab.unk_index,
+                               np.full([len(sents)], vocab.sos_index, dtype=np.int32))
+        mask = np.arange(data.shape[1]) < lengths[:, None]
+        for ll, n in zip(-np.sum(losses * mask, 1, dtype=np.float64), lengths):
+            f_out.write('%.4f\t%d\n' % (ll, n))
+        count += len(sents)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='NumPy-only generation and scoring.')
+    commands = parser.add_subparsers(dest='command')
+    command = commands.add_parser('export', help='export the generator of a checkpoint')
+    command.add_argument('checkpoint')
+    command.add_argument('weights')
+    for name in ['generate', 'score']:
+        command = commands.add_parser(name)
+        command.add_argument('weights')
+        command.add_argument('vocab')
+        command.add_argument('--char_model', action='store_true')
+        command.add_argument('--batch_size', type=int, default=50)
+        if name == 'generate':
+            command.add_argument('-n', type=int, default=10, help='sentences to generate')
+            command.add_argument('--length', type=int, default=50)
+            command.add_argument('--temperature', type=float, default=1.0)
+        else:
+            command.add_argument('input')
+            command.add_argument('output')
+            command.add_argument('--max_length', type=int, default=256)
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+        sys.exit(1)
+    if args.command == 'export':
+        layers = export(args.checkpoint, args.weights)
+        print('Exported %d GRU layers to %s' % (layers, args.weights))
+        return
+
+    start_time = time.time()
+    engine = Engine.load(args.weights)
+    vocab = Vocab(args.vocab, args.char_model)
+    print('Loaded in %.3fs' % (time.time() - start_time))
+    start_time = time.time()
+    if args.command == 'generate':
+        for start in range(0, args.n, args.batch_size):
+            output = engine.sample(min(args.batch_size, args.n - start), args.length,
+                                   vocab.sos_index, args.temperature)
+            for i, sent in enumerate(output, start):
+                print('Sentence %d:' % i, vocab.text(sent))
+        count = args.n
+    else:
+        with open(args.input, 'r') as f_in, open(args.output, 'w') as f_out:
+            count = score_file(engine, vocab, f_in, f_out, args.batch_size, args.max_length)
+    elapsed = time.time() - start_time
+    print('%d sentences in %.2fs: %.0f sentences/sec' % (count, elapsed, count / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,22 @@
+import array
+import collections
+import hashlib
+import itertools
+import multiprocessing
+import os
 from pathlib import Path
 import pickle
+import queue
 import random
+import threading
+import time
 
 import numpy as np
 import tensorflow as tf
 
 from config import cfg
 import utils
+import vocabfile
 
 
 class Vocab(object):
@@ -18,21 +28,49 @@ class Vocab(object):
         self.vocab_lookup = {w: i for i, w in enumerate(self.vocab)}
         self.sos_index = self.vocab_lookup.get('<sos>')
         self.unk_index = self.vocab_lookup.get('<unk>')
+        self.counts = None  # word frequencies, when known
+        self.word_ids = None
+        self.word_dict = None
+        self.char_table = None
+
+    def count_words(self, verbose=True):
+        '''Count the words of the dataset with a process pool over byte ranges of the files.
+           Returns an ordered dict of word to count, in order of first occurrence, and the
+           number of lines.'''
+        fnames = list(Path(cfg.data_path).glob('*.txt'))
+        processes = cfg.vocab_workers or multiprocessing.cpu_count()
+        total_size = sum(fname.stat().st_size for fname in fnames)
+        shard_size = max(total_size // (4 * processes), 1 << 20)
+        shards = []
+        for fname in fnames:
+            if verbose:
+                print(fname)
+            size = fname.stat().st_size
+            for start in range(0, size, shard_size):
+                shards.append((str(fname), start, min(start + shard_size, size),
+                               cfg.char_model))
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.map(_count_words, shards)
+        # merging in shard order keeps the ids in order of first occurrence
+        counts = {}
+        lines = 0
+        for shard_counts, shard_lines in results:
+            lines += shard_lines
+            for word, count in shard_counts.items():
+                counts[word] = counts.get(word, 0) + count
+        return counts, lines
 
     def load_by_parsing(self, save=False, verbose=True):
         '''Read the vocab from the dataset'''
         if verbose:
             print('Loading vocabulary by parsing...')
-        fnames = Path(cfg.data_path).glob('*.txt')
-        for fname in fnames:
-            if verbose:
-                print(fname)
-            with fname.open('r') as f:
-                for line in f:
-                    for word in utils.read_words(line, chars=cfg.char_model):
-                        if word not in self.vocab_lookup:
-                            self.vocab_lookup[word] = len(self.vocab)
-                            self.vocab.append(word)
+        counts, lines = self.count_words(verbose)
+        for word in counts:
+            if word not in self.vocab_lookup:
+                self.vocab_lookup[word] = len(self.vocab)
+                self.vocab.append(word)
+        counts[self.vocab[self.sos_index]] = lines  # every line starts with <sos>
+        self.counts = np.array([counts.get(w, 0) for w in self.vocab], dtype=np.int64)
         if verbose:
             print('Vocabulary loaded, size:', len(self.vocab))
 
@@ -55,25 +93,234 @@ class Vocab(object):
                 if verbose:
                     print('Saved pickle file.')
 
+    def source_key(self):
+        '''Key of what the compact vocab file is built from: the pickle if there is one, else
+           the dataset files, by their sizes and modification times. None if there is neither.'''
+        if cfg.vocab_file.exists():
+            fnames = [cfg.vocab_file]
+        else:
+            fnames = sorted(Path(cfg.data_path).glob('*.txt'))
+        if not fnames:
+            return None
+        key = [str(cfg.char_model)]
+        for fname in fnames:
+            stat = fname.stat()
+            key.append('%s:%d:%d' % (fname.name, stat.st_size, stat.st_mtime_ns))
+        return ';'.join(key).encode('utf-8')
+
+    def load(self, verbose=True):
+        '''Memory-map the compact vocab file, creating it from the pickle (or by parsing) the
+           first time or when its source changed.'''
+        vocab_file = cfg.vocab_file.with_suffix('.vocab')
+        try:
+            self.vocab, self.vocab_lookup, self.counts = vocabfile.load(vocab_file,
+                                                                        self.source_key())
+            if verbose:
+                print('Vocabulary loaded from %s, size: %d' % (vocab_file, len(self.vocab)))
+        except IOError:
+            self.load_from_pickle(verbose=verbose)
+            if self.counts is None:
+                counts, lines = self.count_words(verbose)
+                counts[self.vocab[self.sos_index]] = lines
+                self.counts = np.array([counts.get(w, 0) for w in self.vocab], dtype=np.int64)
+            # the pickle exists now, keyed on it
+            vocabfile.save(vocab_file, self.vocab, self.counts, self.source_key() or b'')
+            if verbose:
+                print('Saved compact vocab file.')
+        self.word_ids = None
+        self.word_dict = None
+        self.char_table = None
+
     def lookup(self, words):
-        return [self.vocab_lookup.get(w) for w in words]
+        '''Ids of words, None for unknown ones. Goes through a dict of the vocab built on first
+           use rather than searching the memory-mapped index for every word.'''
+        if self.word_dict is None:
+            self.word_dict = {w: i for i, w in enumerate(self.vocab)}
+        return [self.word_dict.get(w) for w in words]
 
+    def line_ids(self, line):
+        '''Tokenize a line of text into an int32 array of ids, like lookup(read_words(line)) but
+           with unknown words mapped to <unk>.'''
+        words = line.split()
+        if cfg.char_model:
+            return self._char_ids(words)
+        if self.word_ids is None:
+            self.word_ids = _WordIds(self)
+        ids = np.fromiter(map(self.word_ids.__getitem__, words), dtype=np.int32,
+                          count=len(words))
+        return ids[ids >= 0]
+
+    def _char_ids(self, words):
+        '''Look up the characters of space-joined words through a code point translation
+           table.'''
+        if self.char_table is None:
+            chars = [(ord(c), i) for i, c in enumerate(self.vocab) if len(c) == 1]
+            self.char_table = np.full([max((c for c, _ in chars), default=0) + 2], self.unk_index,
+                                      dtype=np.int32)
+            for c, i in chars:
+                self.char_table[c] = i
+        if '<unk>' in words:
+            # the largest code point is never in the table, so it looks up as <unk>
+            words = [chr(0x10ffff) if w == '<unk>' else w for w in words]
+        codes = np.frombuffer(' '.join(words).encode('utf-32-le'), dtype=np.uint32)
+        # unseen code points fall on the last entry, which maps to <unk>
+        return self.char_table[np.minimum(codes, len(self.char_table) - 1)]
+
+
+class _WordIds(dict):
+
+    '''Cache of raw word to id, normalizing each distinct raw word only once. Words that
+       normalize to nothing map to -1.'''
 
-class Reader(object):
     def __init__(self, vocab):
+        super().__init__()
         self.vocab = vocab
-        random.seed(0)  # deterministic random
+
+    def __missing__(self, raw_word):
+        word = raw_word
+        if word != '<unk>':
+            word = utils.fix_word(word)
+        if word:
+            index = self.vocab.vocab_lookup.get(word, self.vocab.unk_index)
+        else:
+            index = -1
+        self[raw_word] = index
+        return index
+
+
+def _count_words(shard):
+    '''Count the words in the lines starting within a byte range of a file.'''
+    fname, start, end, chars = shard
+    counts = {}
+    lines = 0
+    with open(fname, 'rb') as f:
+        if start:
+            # skip the line in progress, the previous shard counts it
+            f.seek(start - 1)
+            f.readline()
+        pos = f.tell()
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            lines += 1
+            for word in utils.read_words(line.decode('utf-8'), chars=chars):
+                counts[word] = counts.get(word, 0) + 1
+    return counts, lines
+
+
+class Reader(object):
+    def __init__(self, vocab, vectorized=True):
+        self.vocab = vocab
+        self.vectorized = vectorized  # NumPy id arrays instead of per-token Python lists
+        # resumable positions recorded while reading training data, see position()
+        self.snapshots = collections.deque(maxlen=16)
+        self.snapshots_lock = threading.Lock()
+        self.origin = 0
+        self.step_batches = 1  # tracked batches per training batch, see training()
+        self.cache = {}  # id streams of file lists, with cache_corpus
+
+    def read_text_lines(self, fnames):
+        '''Read and tokenize single lines from text data'''
+        for _, _, line in self._read_text_lines_from(fnames):
+            yield line
+
+    def _read_text_lines_from(self, fnames, shard=0, line_no=0):
+        '''Read and tokenize lines from text data starting at a line of a shard, yielding the
+           shard and line number with each line.'''
+        for i in range(shard, len(fnames)):
+            with fnames[i].open('r') as f:
+                start = line_no if i == shard else 0
+                for j, line in enumerate(itertools.islice(f, start, None), start):
+                    if self.vectorized:
+                        yield i, j, self.vocab.line_ids(line)
+                    else:
+                        yield i, j, self.vocab.lookup([w for w in utils.read_words(
+                            line, chars=cfg.char_model)])
 
     def read_lines(self, fnames):
         '''Read single lines from data'''
-        for fname in fnames:
-            with fname.open('r') as f:
-                for line in f:
-                    yield self.vocab.lookup([w for w in utils.read_words(line,
-                                                                         chars=cfg.char_model)])
+        for _, _, line in self._read_lines_from(fnames):
+            yield line
+
+    def _read_lines_from(self, fnames, shard=0, line_no=0, chunk_size=65536):
+        '''Read lines starting at a line of a shard, yielding the shard and line number with
+           each line.'''
+        if not cfg.binary_corpus:
+            yield from self._read_text_lines_from(fnames, shard, line_no)
+            return
+        for i in range(shard, len(fnames)):
+            ids, offsets = self.load_compiled(fnames[i])
+            # convert the index in chunks to keep memory flat for huge corpora
+            for j in range(line_no if i == shard else 0, len(offsets) - 1, chunk_size):
+                bounds = offsets[j:j + chunk_size + 1].tolist()
+                for k, (start, end) in enumerate(zip(bounds[:-1], bounds[1:]), j):
+                    if self.vectorized:
+                        yield i, k, ids[start:end]
+                    else:
+                        yield i, k, ids[start:end].tolist()
+
+    def compiled_files(self, fname):
+        '''Paths of the token and line-offset files compiled from a text file.'''
+        kind = 'char' if cfg.char_model else 'word'
+        return fname.with_suffix('.%s.ids' % kind), fname.with_suffix('.%s.idx' % kind)
+
+    def compile(self, fname, flush_size=1 << 22, verbose=True):
+        '''Tokenize a text file once into a flat int32 token file and an int64 index of line
+           offsets into it.'''
+        if verbose:
+            print('Compiling', fname)
+        ids_file, idx_file = self.compiled_files(fname)
+        tmp_ids = ids_file.with_name(ids_file.name + '.tmp')
+        tmp_idx = idx_file.with_name(idx_file.name + '.tmp')
+        offsets = array.array('q', [0])
+        lines = []
+        with fname.open('r') as f_in, tmp_ids.open('wb') as f:
+            for line in f_in:
+                lines.append(self.vocab.line_ids(line))
+                offsets.append(offsets[-1] + len(lines[-1]))
+                if offsets[-1] - offsets[-1 - len(lines)] >= flush_size:
+                    np.concatenate(lines).tofile(f)
+                    lines = []
+            if lines:
+                np.concatenate(lines).tofile(f)
+        np.frombuffer(offsets, dtype=np.int64).tofile(str(tmp_idx))
+        # the index is written last, so an interrupted compile is never picked up
+        os.replace(str(tmp_ids), str(ids_file))
+        os.replace(str(tmp_idx), str(idx_file))
+        if verbose:
+            print('Compiled %d lines, %d tokens' % (len(offsets) - 1, offsets[-1]))
+
+    def load_compiled(self, fname):
+        '''Memory-map the compiled token and offset files, compiling them if missing or stale.'''
+        ids_file, idx_file = self.compiled_files(fname)
+        sources = [fname, cfg.vocab_file]
+        if not idx_file.exists() or any(idx_file.stat().st_mtime < f.stat().st_mtime
+                                        for f in sources if f.exists()):
+            self.compile(fname)
+        offsets = np.memmap(str(idx_file), dtype=np.int64, mode='r')
+        if offsets[-1]:
+            ids = np.memmap(str(ids_file), dtype=np.int32, mode='r', shape=(offsets[-1],))
+        else:
+            ids = np.zeros([0], dtype=np.int32)
+        return ids, offsets
+
+    def join(self, lines):
+        '''Join id arrays of lines into one array, each line preceded by <sos>.'''
+        sos = np.array([self.vocab.sos_index], dtype=np.int32)
+        return np.concatenate([sos] + [t for line in lines for t in (line, sos)][:-1])
 
     def _prepare(self, lines):
         '''Prepare non-overlapping data'''
+        if not self.vectorized:
+            return self._prepare_lists(lines)
+        ids = self.join(lines)
+        length = len(ids) // cfg.max_sent_length * cfg.max_sent_length
+        return ids[:length].reshape([-1, cfg.max_sent_length])
+
+    def _prepare_lists(self, lines):
+        '''Prepare non-overlapping data from python lists'''
         seqs = []
         seq = []
         for line in lines:
@@ -85,40 +332,178 @@ class Reader(object):
                     seq = []
         return seqs
 
-    def buffered_read(self, fnames, buffer_size=500):
+    def buffered_read(self, fnames, rng, buffer_size=500):
         '''Read and yield a list of non-overlapping sequences'''
         buffer_size = max(buffer_size, cfg.max_sent_length)
         lines = []
         for line in self.read_lines(fnames):
             lines.append(line)
             if len(lines) == buffer_size:
-                random.shuffle(lines)
+                rng.shuffle(lines)
                 yield self._prepare(lines)
                 lines = []
         if lines:
-            random.shuffle(lines)
+            rng.shuffle(lines)
             yield self._prepare(lines)
 
-    def buffered_read_batches(self, fnames, buffer_size=500):
+    def buffered_read_batches(self, fnames, rng, buffer_size=500, position=None, track=False):
+        '''Read shuffled batches, optionally resuming from a position(). With track, the
+           position at the start of every batch buffer is recorded.'''
+        if not self.vectorized:
+            yield from self._buffered_read_list_batches(fnames, rng, buffer_size)
+            return
+        key = tuple(sorted(fnames))
+        if cfg.cache_corpus and (key in self.cache or (position or {}).get('cached')):
+            yield from self.cached_batches(self.cached_ids(fnames), rng, position, track)
+            return
+        # cache the lines in shard order from a full pass
+        cache_lines = None
+        if cfg.cache_corpus and position is None:
+            cache_lines = [[] for _ in fnames]
+        if position is None:
+            position = {'shard': 0, 'line': 0, 'rng': rng.getstate(), 'start': 0, 'skip': 0,
+                        'seqs': np.zeros([0, cfg.max_sent_length], dtype=np.int32)}
+        rng.setstate(position['rng'])
+        seqs = position['seqs']
+        start = position['start']  # batches of the epoch before the current buffer
+        skip = position['skip']  # batches of the current buffer consumed already
+        if track:
+            with self.snapshots_lock:
+                self.snapshots.clear()
+                self.snapshots.append(dict(position, skip=0))
+                self.origin = start + skip
+        lines_iter = self._read_lines_from(fnames, position['shard'], position['line'])
+        line_buffer_size = max(500, cfg.max_sent_length)
+        shard, line_no = position['shard'], position['line'] - 1  # the last line read
+        batches = []
+        while True:
+            lines = list(itertools.islice(lines_iter, line_buffer_size))
+            # without new lines, the sequences a resumed position carried over are still cut
+            # into batches
+            if lines:
+                if cache_lines is not None:
+                    for i, _, line in lines:
+                        cache_lines[i].append(line)
+                shard, line_no, _ = lines[-1]
+                lines = [line for _, _, line in lines]
+                rng.shuffle(lines)
+                seqs = np.concatenate([seqs, self._prepare(lines)])
+            length = len(seqs) // cfg.batch_size * cfg.batch_size
+            for i in range(0, length, cfg.batch_size):
+                batches.append(seqs[i:i + cfg.batch_size])
+                if len(batches) == buffer_size:
+                    rng.shuffle(batches)
+                    start += len(batches)
+                    if track:
+                        # reading resumes from here, the rest of the buffer is regenerated
+                        with self.snapshots_lock:
+                            self.snapshots.append({'shard': shard, 'line': line_no + 1,
+                                                   'rng': rng.getstate(), 'start': start,
+                                                   'skip': 0,
+                                                   'seqs': seqs[i + cfg.batch_size:]})
+                    yield from batches[skip:]
+                    batches = []
+                    skip = 0
+            seqs = seqs[length:]
+            if not lines:
+                break
+        if cache_lines is not None:
+            order = sorted(range(len(fnames)), key=fnames.__getitem__)
+            self.cache[key] = self.join(line for i in order for line in cache_lines[i])
+        # ignore current incomplete batch
+        if batches:
+            rng.shuffle(batches)
+            yield from batches[skip:]
+
+    def cached_ids(self, fnames):
+        '''The id stream of the files in sorted order, read once and then kept in memory.'''
+        key = tuple(sorted(fnames))
+        if key not in self.cache:
+            self.cache[key] = self.join(self.read_lines(list(key)))
+        return self.cache[key]
+
+    def cached_batches(self, ids, rng, position=None, track=False):
+        '''Batches from a cached id stream, cut into sequences at a random offset and shuffled
+           with a single permutation.'''
+        np_rng = np.random.RandomState(rng.getrandbits(32))
+        offset = np_rng.randint(cfg.max_sent_length)
+        num_seqs = (len(ids) - offset) // cfg.max_sent_length
+        seqs = ids[offset:offset + num_seqs * cfg.max_sent_length].reshape(
+            [num_seqs, cfg.max_sent_length])
+        order = np_rng.permutation(num_seqs)
+        first = 0
+        if position is not None:
+            first = position['start'] + position['skip']
+        if track:
+            with self.snapshots_lock:
+                self.snapshots.clear()
+                self.snapshots.append({'start': 0, 'skip': 0, 'cached': True})
+                self.origin = first
+        for i in range(first * cfg.batch_size, num_seqs - cfg.batch_size + 1, cfg.batch_size):
+            yield seqs[order[i:i + cfg.batch_size]]
+
+    def position(self, consumed):
+        '''Resumable position of the tracked batch generator after the consumer took
+           consumed (training) batches from it.'''
+        consumed = consumed * self.step_batches + self.origin
+        with self.snapshots_lock:
+            snapshots = [p for p in self.snapshots if p['start'] <= consumed]
+        if not snapshots:
+            raise ValueError('Reader position is too far behind to resume from, increase the '
+                             'number of snapshots kept')
+        return dict(snapshots[-1], skip=consumed - snapshots[-1]['start'])
+
+    def _buffered_read_list_batches(self, fnames, rng, buffer_size=500):
         batches = []
         batch = []
-        for lines in self.buffered_read(fnames):
+        for lines in self.buffered_read(fnames, rng):
             for line in lines:
                 batch.append(line)
                 if len(batch) == cfg.batch_size:
                     batches.append(self.pack(batch))
                     if len(batches) == buffer_size:
-                        random.shuffle(batches)
+                        rng.shuffle(batches)
                         for batch in batches:
                             yield batch
                         batches = []
                     batch = []
         # ignore current incomplete batch
         if batches:
-            random.shuffle(batches)
+            rng.shuffle(batches)
             for batch in batches:
                 yield batch
 
+    def stream_batches(self, fnames, position=None, track=False, num_rows=None):
+        '''Read batches where row i of each batch continues row i of the previous one, for
+           carrying state across batches. Every batch has an extra last column with the tokens
+           that follow it, which is also the first column of the next batch. Batches have
+           num_rows rows, batch_size by default.'''
+        num_rows = num_rows or cfg.batch_size
+        if cfg.cache_corpus:
+            ids = self.cached_ids(fnames)
+        else:
+            ids = self.join(self.read_lines(fnames))
+        row_length = len(ids) // num_rows
+        rows = ids[:row_length * num_rows].reshape([num_rows, row_length])
+        first = 0
+        if position is not None:
+            first = position['start'] + position['skip']
+        if track:
+            with self.snapshots_lock:
+                self.snapshots.clear()
+                self.snapshots.append({'start': 0, 'skip': 0})
+                self.origin = first
+        for i in range(first * cfg.max_sent_length, row_length - cfg.max_sent_length,
+                       cfg.max_sent_length):
+            yield rows[:, i:i + cfg.max_sent_length + 1]
+
+    def batches(self, fnames, rng, position=None, track=False):
+        '''Read batches in the configured mode.'''
+        if cfg.stateful:
+            yield from self.stream_batches(fnames, position, track)
+        else:
+            yield from self.buffered_read_batches(fnames, rng, position=position, track=track)
+
     def pack(self, batch):
         '''Pack python-list batches into numpy batches'''
         ret_batch = np.zeros([cfg.batch_size, cfg.max_sent_length], dtype=np.int32)
@@ -126,43 +511,203 @@ class Reader(object):
             ret_batch[i, :len(s)] = s
         return ret_batch
 
-    def training(self):
-        '''Read batches from training data'''
-        yield from self.buffered_read_batches([Path(cfg.data_path) / 'train.txt'])
+    def training_files(self):
+        '''Training shard files.'''
+        return sorted(Path(cfg.data_path).glob(cfg.train_files))
+
+    def training(self, epoch=0, position=None, num_towers=1):
+        '''Read batches from training data, shuffled deterministically by the seed and epoch,
+           optionally resuming from a position() of the same epoch. For data-parallel towers,
+           each batch stacks a disjoint batch_size rows for every tower: num_towers consecutive
+           batches, or in stateful mode batches of a stream with num_towers times the rows, so
+           that the rows of a tower continue its own.'''
+        rng = random.Random('%d:%d' % (cfg.shuffle_seed, epoch))
+        fnames = self.training_files()
+        rng.shuffle(fnames)
+        if num_towers == 1:
+            self.step_batches = 1
+            yield from self.batches(fnames, rng, position, track=True)
+        elif cfg.stateful:
+            self.step_batches = 1
+            yield from self.stream_batches(fnames, position, track=True,
+                                           num_rows=num_towers * cfg.batch_size)
+        else:
+            self.step_batches = num_towers
+            batches = self.buffered_read_batches(fnames, rng, position=position, track=True)
+            for group in zip(*[batches] * num_towers):
+                yield np.concatenate(group)
 
     def validation(self):
         '''Read batches from validation data'''
-        yield from self.buffered_read_batches([Path(cfg.data_path) / 'valid.txt'])
+        yield from self.batches([Path(cfg.data_path) / 'valid.txt'],
+                                random.Random(cfg.shuffle_seed))
 
     def testing(self):
         '''Read batches from testing data'''
-        yield from self.buffered_read_batches([Path(cfg.data_path) / 'test.txt'])
+        yield from self.batches([Path(cfg.data_path) / 'test.txt'],
+                                random.Random(cfg.shuffle_seed))
+
+
+class Prefetcher(object):
+
+    '''Iterate over a batch generator from a background thread, keeping a bounded number of
+       batches ready. wait_time accumulates the seconds the consumer spent blocked on data.'''
+
+    _end = object()
+
+    def __init__(self, batches, num_batches):
+        self.queue = queue.Queue(maxsize=num_batches)
+        self.wait_time = 0.0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._fill, args=(batches,), daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _fill(self, batches):
+        try:
+            for batch in batches:
+                if not self._put(batch):
+                    return
+        except Exception as e:  # re-raised in the consuming thread
+            self._put(e)
+            return
+        self._put(self._end)
+
+    def __iter__(self):
+        while True:
+            start_time = time.time()
+            item = self.queue.get()
+            self.wait_time += time.time() - start_time
+            if item is self._end:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def close(self):
+        '''Stop the background thread, e.g. when the consumer stops early.'''
+        self.stopped.set()
+        self.thread.join()
+
+
+class QueueFeeder(object):
+
+    '''Fill the in-graph input queue of a model (see RNNLMModel.input_queue) from a batch
+       generator in a background thread, so that the training steps dequeue their batches
+       without a feed. Iterating yields the same batches in the same order for the consumer's
+       bookkeeping, and wait_time accumulates the seconds the consumer spent blocked on data.'''
+
+    _end = object()
+
+    def __init__(self, session, model, batches):
+        self.session = session
+        self.model = model
+        # batches are put here before they are enqueued, so a batch is always known to the
+        # consumer by the time its step can dequeue it
+        self.queue = queue.Queue()
+        self.wait_time = 0.0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._fill, args=(batches,), daemon=True)
+        self.thread.start()
+
+    def _enqueue(self, batch):
+        # time out regularly to notice when stopped while the input queue is full
+        options = tf.RunOptions(timeout_in_ms=100)
+        while not self.stopped.is_set():
+            try:
+                self.session.run(self.model.enqueue_op, {self.model.enqueue_batch: batch},
+                                 options=options)
+                return True
+            except tf.errors.DeadlineExceededError:
+                pass
+        return False
+
+    def _fill(self, batches):
+        try:
+            for batch in batches:
+                self.queue.put(batch)
+                if not self._enqueue(batch):
+                    return
+        except Exception as e:  # re-raised in the consuming thread
+            self.queue.put(e)
+            return
+        self.queue.put(self._end)
+
+    def __iter__(self):
+        while True:
+            start_time = time.time()
+            item = self.queue.get()
+            self.wait_time += time.time() - start_time
+            if item is self._end:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def close(self):
+        '''Stop the background thread and empty the input queue of the batches that were not
+           consumed, e.g. when the consumer stops early.'''
+        self.stopped.set()
+        self.thread.join()
+        self.session.run(self.model.drain_op)
+
+
+def check_resume(reader, num_towers=1):
+    '''Check that resuming the first training epoch from the position after every number of
+       batches yields the rest of an uninterrupted pass. Returns the number of batches of the
+       epoch and the numbers of batches that resume differently.'''
+    batches = []
+    positions = []
+    for k, batch in enumerate(reader.training(0, num_towers=num_towers)):
+        positions.append(reader.position(k))
+        batches.append(batch.tobytes())
+    failed = []
+    for k, position in enumerate(positions):
+        rest = [batch.tobytes() for batch in reader.training(0, position, num_towers)]
+        if rest != batches[k:]:
+            failed.append(k)
+    return len(batches), failed
 
 
 def main(_):
     '''Reader tests'''
 
     vocab = Vocab()
-    vocab.load_from_pickle()
+    vocab.load()
+
+    digests = []
+    for vectorized in [False, True]:
+        reader = Reader(vocab, vectorized=vectorized)
+        digest = hashlib.md5()
+        c = 0
+        w = 0
+        start_time = time.time()
+        for batch in reader.training():
+            n_words = np.sum(batch != 0)
+            w += n_words
+            c += len(batch)
+            digest.update(batch.tobytes())
+        elapsed = time.time() - start_time
+        digests.append(digest.hexdigest())
+        print('\nVectorized:' if vectorized else '\nPer-token lists:')
+        print('Total lines:', c)
+        print('Total words:', w)
+        print('Time: %.2fs  speed: %.0f wps' % (elapsed, w / elapsed))
+    print('\nIdentical output:', digests[0] == digests[1])
 
     reader = Reader(vocab)
-    c = 0
-    w = 0
-    for batch in reader.training():
-        n_words = np.sum(batch != 0)
-        w += n_words
-        c += len(batch)
-        #for line in batch:
-        #    print(line)
-        #    for e in line:
-        #        if cfg.char_model:
-        #            print(vocab.vocab[e], end='')
-        #        else:
-        #            print(vocab.vocab[e], end=' ')
-        #    print()
-        #    print()
-    print('Total lines:', c)
-    print('Total words:', w)
+    for num_towers in [1, 2]:
+        num_batches, failed = check_resume(reader, num_towers)
+        print('Resume with %d towers: %d of %d positions failed %s' % (num_towers, len(failed),
+                                                                       num_batches, failed[:10]))
 
 
 if __name__ == '__main__':
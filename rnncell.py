@@ -1,8 +1,28 @@
+import collections
+import re
+
+import numpy as np
 import tensorflow as tf
+from tensorflow.python.framework import function
 
 import utils
 
 
+# Structured return_states outputs of MultiRNNCell: the top layer output, the prediction ids
+# (int32 bits in a tensor of the compute dtype, see prediction_ids), the embeddings of the
+# predictions and the tuple of layer states. Parts that are not produced are empty tuples.
+RNNOutputs = collections.namedtuple('RNNOutputs', ['output', 'prediction', 'embeddings',
+                                                   'states'])
+
+
+def prediction_ids(prediction):
+    """Recover the int32 ids from the prediction part of structured outputs."""
+    ids = tf.bitcast(prediction, tf.int32)
+    if prediction.dtype.size == 4:
+        ids = tf.squeeze(ids, [-1])
+    return ids
+
+
 class GRUCell(tf.nn.rnn_cell.RNNCell):
 
     """Gated Recurrent Unit cell (cf. http://arxiv.org/abs/1406.1078)."""
@@ -43,22 +63,225 @@ class GRUCell(tf.nn.rnn_cell.RNNCell):
         return new_h, new_state
 
 
+class ProjectedGRUCell(tf.nn.rnn_cell.RNNCell):
+
+    """GRU cell whose inputs are already projected for the gates and the candidate, so that
+    only the state matmuls remain inside the recurrence. The output is the new state."""
+
+    def __init__(self, num_units, gates_matrix, candidate_matrix, pretanh=False,
+                 activation=tf.nn.tanh):
+        self.num_units = num_units
+        self.gates_matrix = gates_matrix  # state part, [num_units, 2 * num_units]
+        self.candidate_matrix = candidate_matrix  # state part, [num_units, num_units]
+        self.pretanh = pretanh
+        self.activation = activation
+
+    @property
+    def state_size(self):
+        if self.pretanh:
+            return 2 * self.num_units
+        else:
+            return self.num_units
+
+    @property
+    def output_size(self):
+        return self.state_size
+
+    def __call__(self, inputs, state, scope=None):
+        """Gated recurrent unit (GRU) on projected inputs [gates, candidate]."""
+        if self.pretanh:
+            state = state[:, :self.num_units]
+        gates = inputs[:, :2 * self.num_units] + tf.matmul(state, self.gates_matrix)
+        r, u = tf.split(1, 2, tf.nn.sigmoid(gates))
+        preact = inputs[:, 2 * self.num_units:] + tf.matmul(r * state, self.candidate_matrix)
+        new_h = u * state + (1 - u) * self.activation(preact)
+        if self.pretanh:
+            new_state = tf.concat(1, [new_h, preact])
+        else:
+            new_state = new_h
+        return new_state, new_state
+
+
+def _gru_variables(input_size, num_units, dtype=tf.float32):
+    """The variables of a GRUCell with these sizes, created or reused in the current scope and
+    cast to dtype."""
+    with tf.variable_scope("Gates"), tf.variable_scope("Linear"):
+        gates_matrix = tf.get_variable("Matrix", [input_size + num_units, 2 * num_units],
+                                       initializer=tf.contrib.layers.xavier_initializer())
+        gates_bias = tf.get_variable("Bias", [2 * num_units],
+                                     initializer=tf.constant_initializer(1.0))
+    with tf.variable_scope("Candidate"), tf.variable_scope("Linear"):
+        candidate_matrix = tf.get_variable("Matrix", [input_size + num_units, num_units],
+                                           initializer=tf.contrib.layers.xavier_initializer())
+        candidate_bias = tf.get_variable("Bias", [num_units],
+                                         initializer=tf.constant_initializer(0.0))
+    return tuple(utils.cast_to(v, dtype) for v in [gates_matrix, gates_bias, candidate_matrix,
+                                                   candidate_bias])
+
+
+def _project_inputs(inputs, input_size, gates_matrix, gates_bias, candidate_matrix,
+                    candidate_bias):
+    """The input halves of the GRU matmuls for all timesteps of [batch, time, input_size] inputs
+    in one matmul, as [batch * time, 3 * num_units]."""
+    input_matrix = tf.concat(1, [gates_matrix[:input_size], candidate_matrix[:input_size]])
+    projected = tf.matmul(tf.reshape(inputs, [-1, input_size]), input_matrix)
+    return tf.nn.bias_add(projected, tf.concat(0, [gates_bias, candidate_bias]))
+
+
+def _rnn_outputs(layer_outputs, num_units, pretanh, reverse):
+    """RNNOutputs from the per-layer outputs of ProjectedGRUCells."""
+    outputs = [layer_outputs[-1][:, :, :num_units]]
+    if pretanh:
+        outputs.extend(output[:, :, num_units:] for output in layer_outputs)
+    else:
+        # skip the last layer states, since they're outputs
+        outputs.extend(layer_outputs[:-1])
+    if reverse:
+        outputs = [tf.reverse(output, [False, True, False]) for output in outputs]
+    return RNNOutputs(outputs[0], (), (), tuple(outputs[1:]))
+
+
+def hoisted_rnn(inputs, num_layers, num_units, pretanh=False, initial_state=None, reverse=False,
+                swap_memory=True, scope=None):
+    """Equivalent of dynamic_rnn with a MultiRNNCell of GRUCells and structured return_states
+    outputs on full-length batch-major inputs, with the same variables. Each layer is run
+    separately, so the input halves of its matmuls are computed for all timesteps in one matmul
+    before the recurrence. With reverse, the inputs are read backwards (outputs stay in input
+    order). Returns the RNNOutputs and the tuple of final states."""
+    batch_size, num_steps, _ = inputs.get_shape().as_list()
+    if reverse:
+        inputs = tf.reverse(inputs, [False, True, False])
+    layer_inputs = inputs
+    final_states = []
+    layer_outputs = []
+    with tf.variable_scope(scope or "RNN"), tf.variable_scope("MultiRNNCell"):
+        for i in range(num_layers):
+            input_size = layer_inputs.get_shape()[2].value
+            with tf.variable_scope("Layer%d" % i), tf.variable_scope("GRUCell"):
+                gates_matrix, gates_bias, candidate_matrix, candidate_bias = \
+                    _gru_variables(input_size, num_units, inputs.dtype)
+                projected = _project_inputs(layer_inputs, input_size, gates_matrix, gates_bias,
+                                            candidate_matrix, candidate_bias)
+                projected = tf.reshape(projected, [batch_size, num_steps, 3 * num_units])
+                cell = ProjectedGRUCell(num_units, gates_matrix[input_size:],
+                                        candidate_matrix[input_size:], pretanh=pretanh)
+                if initial_state is None:
+                    layer_state = None
+                else:
+                    layer_state = initial_state[i]
+                outputs, final_state = tf.nn.dynamic_rnn(cell, projected,
+                                                         initial_state=layer_state,
+                                                         swap_memory=swap_memory,
+                                                         dtype=inputs.dtype, scope="Recurrence")
+            layer_inputs = outputs[:, :, :num_units]
+            layer_outputs.append(outputs)
+            final_states.append(final_state)
+    return _rnn_outputs(layer_outputs, num_units, pretanh, reverse), tuple(final_states)
+
+
+def recompute_rnn(inputs, num_layers, num_units, segment_length, pretanh=False,
+                  initial_state=None, reverse=False, scope=None):
+    """Equivalent of hoisted_rnn that only keeps the states at every segment_length-th timestep
+    for the backward pass. Each segment of timesteps runs as one function call, and the gradient
+    of a function call recomputes its activations from the saved inputs and states, so the
+    activations inside the cells are only held for one segment at a time."""
+    batch_size, num_steps, input_size = inputs.get_shape().as_list()
+    if pretanh:
+        state_size = 2 * num_units
+    else:
+        state_size = num_units
+    if reverse:
+        inputs = tf.reverse(inputs, [False, True, False])
+    with tf.variable_scope(scope or "RNN"), tf.variable_scope("MultiRNNCell"):
+        weights = []
+        for i in range(num_layers):
+            with tf.variable_scope("Layer%d" % i), tf.variable_scope("GRUCell"):
+                weights.extend(_gru_variables(input_size if i == 0 else num_units, num_units,
+                                              inputs.dtype))
+        name = re.sub('[^A-Za-z0-9_]', '_', tf.get_variable_scope().name)
+    # functions can't read variables, so the weights are passed in as one flat vector
+    weight_shapes = [w.get_shape().as_list() for w in weights]
+    weights = tf.concat(0, [tf.reshape(w, [-1]) for w in weights])
+    if initial_state is None:
+        states = tf.zeros([batch_size, num_layers * state_size], inputs.dtype)
+    else:
+        states = tf.concat(1, list(initial_state))
+
+    def segment_fn(length):
+        """The function running length timesteps of all layers."""
+        def run_segment(seg_inputs, states, weights):
+            # function arguments come without static shapes
+            layer_inputs = tf.reshape(seg_inputs, [batch_size, length, input_size])
+            states = tf.split(1, num_layers, tf.reshape(states, [batch_size, -1]))
+            params = []
+            offset = 0
+            for shape in weight_shapes:
+                size = int(np.prod(shape))
+                params.append(tf.reshape(weights[offset:offset + size], shape))
+                offset += size
+            layer_outputs = []
+            final_states = []
+            for i in range(num_layers):
+                layer_size = input_size if i == 0 else num_units
+                gates_matrix, gates_bias, candidate_matrix, candidate_bias = params[4 * i:4 * i + 4]
+                projected = _project_inputs(layer_inputs, layer_size, gates_matrix, gates_bias,
+                                            candidate_matrix, candidate_bias)
+                projected = tf.reshape(projected, [batch_size, length, 3 * num_units])
+                cell = ProjectedGRUCell(num_units, gates_matrix[layer_size:],
+                                        candidate_matrix[layer_size:], pretanh=pretanh)
+                state = states[i]
+                outputs = []
+                for t in range(length):
+                    output, state = cell(projected[:, t, :], state)
+                    outputs.append(output)
+                outputs = tf.pack(outputs, axis=1)
+                layer_inputs = outputs[:, :, :num_units]
+                layer_outputs.append(outputs)
+                final_states.append(state)
+            return tuple(layer_outputs) + (tf.concat(1, final_states),)
+        return function.Defun(inputs.dtype, inputs.dtype, inputs.dtype,
+                              func_name='%s_Segment%d' % (name, length))(run_segment)
+
+    segment_fns = {}
+    layer_outputs = [[] for _ in range(num_layers)]
+    for start in range(0, num_steps, segment_length):
+        length = min(segment_length, num_steps - start)
+        if length not in segment_fns:
+            segment_fns[length] = segment_fn(length)
+        ret = segment_fns[length](inputs[:, start:start + length, :], states, weights)
+        for i in range(num_layers):
+            ret[i].set_shape([batch_size, length, state_size])
+            layer_outputs[i].append(ret[i])
+        states = ret[-1]
+        states.set_shape([batch_size, num_layers * state_size])
+    layer_outputs = [tf.concat(1, outputs) for outputs in layer_outputs]
+    return (_rnn_outputs(layer_outputs, num_units, pretanh, reverse),
+            tuple(tf.split(1, num_layers, states)))
+
+
 class MultiRNNCell(tf.nn.rnn_cell.RNNCell):
 
     """RNN cell composed sequentially of multiple simple cells."""
 
     def __init__(self, cells, embedding=None, softmax_w=None, softmax_b=None, return_states=False,
-                 outputs_are_states=True, pretanh=False, get_embeddings=False):
+                 outputs_are_states=True, pretanh=False, get_embeddings=False, structured=False,
+                 dtype=tf.float32, sampler=None):
         """Create a RNN cell composed sequentially of a number of RNNCells. If embedding is not
            None, the output of the previous timestep is used for the current time step using the
-           softmax variables.
+           softmax variables. With structured, return_states outputs are an RNNOutputs tuple
+           instead of one concatenated tensor. dtype is the compute dtype of the inputs and
+           states, the variables are cast to it. sampler, if given, replaces the softmax
+           variables (which can then be None) for sampling the predictions: it maps the outputs
+           to int64 ids.
         """
         if not cells:
             raise ValueError("Must specify at least one cell for MultiRNNCell.")
         self.cells = cells
-        if not (embedding is None and softmax_w is None and softmax_b is None) and \
-           not (embedding is not None and softmax_w is not None and softmax_b is not None):
-            raise ValueError('Embedding and softmax variables have to all be None or all not None.')
+        if embedding is None:
+            if not (softmax_w is None and softmax_b is None):
+                raise ValueError('Softmax variables are only used with an embedding.')
+        elif sampler is None and (softmax_w is None or softmax_b is None):
+            raise ValueError('An embedding needs the softmax variables or a sampler.')
         self.embedding = embedding
         self.softmax_w = softmax_w
         self.softmax_b = softmax_b
@@ -66,6 +289,9 @@ class MultiRNNCell(tf.nn.rnn_cell.RNNCell):
         self.outputs_are_states = outputs_are_states  # should be true for GRUs
         self.pretanh = pretanh
         self.get_embeddings = get_embeddings
+        self.structured = structured
+        self.dtype = dtype
+        self.sampler = sampler
         if embedding is not None:
             self.emb_size = embedding.get_shape()[1]
         else:
@@ -82,16 +308,21 @@ class MultiRNNCell(tf.nn.rnn_cell.RNNCell):
     def output_size(self):
         size = self.cells[-1].output_size
         if self.return_states:
-            if not self.pretanh and self.outputs_are_states:
-                skip = 1
-            else:
-                skip = 0
             if self.pretanh:
-                size += sum(cell.state_size // 2 for cell in self.cells)
+                states = [cell.state_size // 2 for cell in self.cells]
+            elif self.outputs_are_states:
+                # skip the last layer states, since they're outputs
+                states = [cell.state_size for cell in self.cells[:-1]]
             else:
-                size += sum(cell.state_size for cell in self.cells[:-skip])
+                states = [cell.state_size for cell in self.cells]
             if self.get_embeddings:
-                size += self.embedding.get_shape()[1].value
+                emb_size = self.embedding.get_shape()[1].value
+            if self.structured:
+                return RNNOutputs(size, 4 // self.dtype.size if self.emb_size else (),
+                                  emb_size if self.get_embeddings else (), tuple(states))
+            size += sum(states)
+            if self.get_embeddings:
+                size += emb_size
         if self.emb_size:
             size += 1  # for the current timestep prediction
         return size
@@ -99,8 +330,8 @@ class MultiRNNCell(tf.nn.rnn_cell.RNNCell):
     def initial_state(self, initial):
         '''Generate the required initial state from $initial.'''
         if self.emb_size:
-            initial.append(tf.zeros([initial[0].get_shape()[0], self.emb_size]))
-            initial.append(tf.zeros([initial[0].get_shape()[0], 1]))
+            initial.append(tf.zeros([initial[0].get_shape()[0], self.emb_size], self.dtype))
+            initial.append(tf.zeros([initial[0].get_shape()[0], 1], self.dtype))
         return tuple(initial)
 
     def __call__(self, inputs, state, scope=None):
@@ -127,27 +358,46 @@ class MultiRNNCell(tf.nn.rnn_cell.RNNCell):
                             ret_states.append(new_state[:, size // 2:])
                         else:
                             ret_states.append(new_state)
-            if self.embedding is not None:
-                logits = tf.nn.bias_add(tf.matmul(cur_inp, tf.transpose(self.softmax_w),
+            if self.embedding is not None and self.sampler is not None:
+                prediction = self.sampler(cur_inp)
+            elif self.embedding is not None:
+                softmax_w = utils.cast_to(self.softmax_w, self.dtype)
+                logits = tf.nn.bias_add(tf.matmul(cur_inp, tf.transpose(softmax_w),
                                                   name='Softmax_transform'),
-                                        self.softmax_b)
-                logits = tf.nn.log_softmax(logits)
+                                        utils.cast_to(self.softmax_b, self.dtype))
+                # sample in float32
+                logits = tf.nn.log_softmax(tf.cast(logits, tf.float32))
                 dist = tf.contrib.distributions.Categorical(logits)
                 prediction = tf.cast(dist.sample(), tf.int64)
+            if self.embedding is not None:
                 with tf.device('/cpu:0'):
                     embeddings = tf.nn.embedding_lookup(self.embedding, prediction,
                                                         name='rnn_embedding_k1')
+                embeddings = utils.cast_to(embeddings, self.dtype)
                 new_states.append(embeddings)
-                if self.return_states and self.get_embeddings:
-                    ret_states.insert(0, embeddings)
-                new_states.append(tf.ones([inputs.get_shape()[0], 1]))  # we have valid prev input
+                # we have valid prev input
+                new_states.append(tf.ones([inputs.get_shape()[0], 1], self.dtype))
         if self.return_states:
-            output = [cur_inp]
-            if self.embedding is not None:
-                output.append(tf.cast(tf.expand_dims(prediction, -1), tf.float32))
             if not self.pretanh and self.outputs_are_states:
                 # skip the last layer states, since they're outputs
                 ret_states = ret_states[:-1]
+            if self.structured:
+                # dynamic_rnn stores all outputs with the state dtype, so the ids travel as
+                # their raw bits rather than being converted to float
+                if self.embedding is not None:
+                    prediction = tf.reshape(tf.bitcast(tf.cast(prediction, tf.int32),
+                                                       self.dtype), [inputs.get_shape()[0], -1])
+                else:
+                    prediction = ()
+                if not (self.embedding is not None and self.get_embeddings):
+                    embeddings = ()
+                return (RNNOutputs(cur_inp, prediction, embeddings, tuple(ret_states)),
+                        tuple(new_states))
+            output = [cur_inp]
+            if self.embedding is not None:
+                output.append(tf.cast(tf.expand_dims(prediction, -1), self.dtype))
+                if self.get_embeddings:
+                    ret_states.insert(0, embeddings)
             return tf.concat(1, output + ret_states), tuple(new_states)
         else:
             return cur_inp, tuple(new_states)
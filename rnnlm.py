@@ -2,40 +2,134 @@ import tensorflow as tf
 
 from config import cfg
 import rnncell
+from softmax import AdaptiveSoftmax
 import utils
 
 
 class RNNLMModel(object):
 
-    '''The adversarial recurrent language model.'''
+    '''The adversarial recurrent language model. With eval_only, only the embeddings, the MLE
+       generator and its loss are built (no free-running generator, discriminator or training
+       ops, generated is None). Its variables are a subset of the full model's, so it restores
+       from full checkpoints. With input_queue, the batches are dequeued from an in-graph queue
+       (see reader.QueueFeeder) instead of being fed to data, which can still be fed to
+       override them. With num_towers, the batch has batch_size rows for each of the
+       data-parallel towers, which share the variables and average their gradients.'''
 
-    def __init__(self, vocab, training, use_gan=True, g_optimizer=None, d_optimizer=None):
+    def __init__(self, vocab, training, use_gan=True, g_optimizer=None, d_optimizer=None,
+                 eval_only=False, input_queue=False, num_towers=1):
         self.vocab = vocab
         self.training = training
         self.g_optimizer = g_optimizer
         self.d_optimizer = d_optimizer
 
         self.embedding = self.word_embedding_matrix()
-        self.softmax_w, self.softmax_b = self.softmax_variables()
+        if cfg.adaptive_softmax:
+            # the full [vocab_size, hidden_size] softmax is never used, it isn't created
+            self.softmax_w = self.softmax_b = None
+            self.adaptive_softmax = AdaptiveSoftmax(vocab.counts, cfg.adaptive_cutoffs,
+                                                    cfg.hidden_size)
+        else:
+            self.softmax_w, self.softmax_b = self.softmax_variables()
+            self.adaptive_softmax = None
 
         with tf.variable_scope("GlobalMLE"):
             self.global_step = tf.get_variable('global_step', shape=[],
                                                initializer=tf.zeros_initializer,
                                                trainable=False)
-        # input data
-        self.data = tf.placeholder(tf.int32, [cfg.batch_size, cfg.max_sent_length], name='data')
+        # input data, the rows of all the towers
+        num_rows = num_towers * cfg.batch_size
+        if input_queue:
+            batch = self.input_queue(num_rows)
+            self.data = batch[:, :cfg.max_sent_length]
+        else:
+            self.enqueue_op = None
+            self.data = tf.placeholder(tf.int32, [num_rows, cfg.max_sent_length], name='data')
+
+        if cfg.stateful:
+            # state carried over from the previous batch, and the tokens following this batch
+            state_shape = [num_rows, 2 * cfg.hidden_size]  # pretanh GRU states
+            self.initial_state = tuple(tf.placeholder_with_default(tf.zeros(state_shape),
+                                                                   state_shape)
+                                       for _ in range(cfg.num_layers))
+            if input_queue:
+                next_tokens = batch[:, -1]
+            else:
+                next_tokens = tf.zeros([num_rows], tf.int32)
+            self.next_tokens = tf.placeholder_with_default(next_tokens, [num_rows],
+                                                           name='next_tokens')
+        else:
+            self.initial_state = None
+
+        if eval_only:
+            use_gan = False
+        self.use_gan = use_gan
+        towers = []
+        for i in range(num_towers):
+            rows = slice(i * cfg.batch_size, (i + 1) * cfg.batch_size)
+            if cfg.stateful:
+                next_tokens = self.next_tokens[rows]
+                initial_state = tuple(s[rows] for s in self.initial_state)
+            else:
+                next_tokens = None
+                initial_state = None
+            if i == 0:
+                towers.append(self.tower(self.data[rows], next_tokens, initial_state, use_gan,
+                                         eval_only))
+            else:
+                # the other towers share the variables of the first
+                with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+                    towers.append(self.tower(self.data[rows], next_tokens, initial_state,
+                                             use_gan, eval_only))
+        nlls, losses, final_states, generated, d_costs, g_costs = zip(*towers)
+        if num_towers == 1:
+            self.losses = losses[0]
+            self.nll = nlls[0]
+            self.final_state = final_states[0]
+            self.generated = generated[0]
+            self.d_cost = d_costs[0]
+            self.g_cost = g_costs[0]
+        else:
+            self.losses = tf.concat(0, losses)
+            self.nll = tf.add_n(nlls) / num_towers
+            self.final_state = tuple(tf.concat(0, s) for s in zip(*final_states))
+            if eval_only:
+                self.generated = None
+            else:
+                self.generated = tf.concat(0, generated)
+            self.d_cost = tf.add_n(d_costs) / num_towers
+            self.g_cost = tf.add_n(g_costs) / num_towers
+        self.mle_cost = self.nll
+        if training:
+            self.mle_train_op = self.train_mle(nlls)
+        else:
+            self.mle_train_op = tf.no_op()
+        if training and use_gan:
+            self.d_train_op = self.train_d(d_costs)
+            self.g_train_op = self.train_g(g_costs)
+        else:
+            self.d_train_op = tf.no_op()
+            self.g_train_op = tf.no_op()
 
-        embs = self.word_embeddings(self.data)
-        output, mle_states, _ = self.generator(embs, True)
-        _, gan_states, self.generated = self.generator(embs, False, True)
+    def tower(self, data, next_tokens, initial_state, use_gan, eval_only):
+        '''Build the model on batch_size rows of data. Returns their MLE nll, per-position
+           losses, final generator state, generated sentences (None with eval_only) and GAN
+           costs.'''
+        embs = self.word_embeddings(data)
+        output, mle_states, _, final_state = self.generator(embs, True,
+                                                            initial_state=initial_state)
+        if eval_only:
+            generated = None
+        else:
+            _, gan_states, generated, _ = self.generator(embs, False, True)
         if use_gan:
             states = tf.concat(0, [mle_states, gan_states])
 
             if cfg.d_energy_based:
                 d_out = self.discriminator_energy(states)
                 d_loss, g_loss = self.gan_energy_loss(d_out[:, :-1, :], states)
-                self.d_cost = tf.reduce_sum(d_loss) / (2 * cfg.batch_size)
-                self.g_cost = tf.reduce_sum(g_loss) / (2 * cfg.batch_size)
+                d_cost = tf.reduce_sum(d_loss) / (2 * cfg.batch_size)
+                g_cost = tf.reduce_sum(g_loss) / (2 * cfg.batch_size)
             else:
                 if cfg.d_rnn:
                     d_out = self.discriminator_rnn(states)
@@ -44,35 +138,55 @@ class RNNLMModel(object):
                 targets = tf.concat(0, [tf.ones([cfg.batch_size, 1]),
                                         tf.zeros([cfg.batch_size, 1])])
                 gan_loss = self.gan_loss(d_out, targets)
-                self.d_cost = tf.reduce_sum(gan_loss) / (2 * cfg.batch_size)
-                self.g_cost = -self.d_cost
+                d_cost = tf.reduce_sum(gan_loss) / (2 * cfg.batch_size)
+                g_cost = -d_cost
         else:
-            self.d_cost = tf.zeros([])
-            self.g_cost = tf.zeros([])
+            d_cost = tf.zeros([])
+            g_cost = tf.zeros([])
 
         # shift left the input to get the targets
-        targets = tf.concat(1, [self.data[:, 1:], tf.zeros([cfg.batch_size, 1], tf.int32)])
-        self.nll = tf.reduce_sum(self.mle_loss(output, targets)) / cfg.batch_size
-        self.mle_cost = self.nll
-        if training:
-            self.mle_train_op = self.train_mle(self.mle_cost)
+        if next_tokens is not None:
+            next_tokens = tf.expand_dims(next_tokens, 1)
         else:
-            self.mle_train_op = tf.no_op()
-        if training and use_gan:
-            self.d_train_op = self.train_d(self.d_cost)
-            self.g_train_op = self.train_g(self.g_cost)
-        else:
-            self.d_train_op = tf.no_op()
-            self.g_train_op = tf.no_op()
+            next_tokens = tf.zeros([cfg.batch_size, 1], tf.int32)
+        targets = tf.concat(1, [data[:, 1:], next_tokens])
+        losses = self.mle_loss(output, targets)
+        nll = tf.reduce_sum(losses) / cfg.batch_size
+        return nll, losses, final_state, generated, d_cost, g_cost
+
+    def input_queue(self, num_rows):
+        '''Create the queue of input batches, which have the next tokens as an extra last column
+           in stateful mode, with the ops to fill and empty it. Returns a dequeued batch. Each
+           training step still dequeues one batch in its own session.run: a run reads every
+           variable once, so several optimizer steps per run would need the whole model rebuilt
+           on explicit reads inside a while loop, which isn't done.'''
+        width = cfg.max_sent_length + 1 if cfg.stateful else cfg.max_sent_length
+        queue = tf.FIFOQueue(max(cfg.prefetch_batches, 1), [tf.int32],
+                             shapes=[[num_rows, width]], name='input_queue')
+        self.enqueue_batch = tf.placeholder(tf.int32, [num_rows, width], name='enqueue_batch')
+        self.enqueue_op = queue.enqueue(self.enqueue_batch)
+        self.drain_op = queue.dequeue_many(queue.size())
+        return queue.dequeue()
 
     def rnn_cell(self, num_layers, hidden_size, embedding=None, softmax_w=None, softmax_b=None,
-                 return_states=False, pretanh=False, get_embeddings=False):
+                 return_states=False, pretanh=False, get_embeddings=False, structured=True,
+                 sampler=None):
         '''Return a multi-layer RNN cell.'''
         return rnncell.MultiRNNCell([rnncell.GRUCell(hidden_size, pretanh=pretanh)
                                      for _ in range(num_layers)], embedding=embedding,
                                     softmax_w=softmax_w, softmax_b=softmax_b,
                                     return_states=return_states, pretanh=pretanh,
-                                    get_embeddings=get_embeddings)
+                                    get_embeddings=get_embeddings, structured=structured,
+                                    dtype=cfg.dtype, sampler=sampler)
+
+    def fused_rnn(self, inputs, num_layers, hidden_size, **kwargs):
+        '''GRU layers on inputs known in advance, with the variables of rnn_cell. Segments of
+           recompute_every timesteps are recomputed in the backward pass if it is set, otherwise
+           the input projections are hoisted out of the recurrence.'''
+        if cfg.recompute_every > 0:
+            return rnncell.recompute_rnn(inputs, num_layers, hidden_size, cfg.recompute_every,
+                                         **kwargs)
+        return rnncell.hoisted_rnn(inputs, num_layers, hidden_size, **kwargs)
 
     def word_embedding_matrix(self):
         '''Define the word embedding matrix.'''
@@ -91,88 +205,182 @@ class RNNLMModel(object):
                                         initializer=tf.zeros_initializer)
         return softmax_w, softmax_b
 
+    def output_logits(self, outputs):
+        '''Full-vocabulary float32 logits for a batch of generator outputs (log-probabilities
+           with the adaptive softmax).'''
+        if self.adaptive_softmax is not None:
+            return self.adaptive_softmax.log_probs(outputs)
+        softmax_w = utils.cast_to(self.softmax_w, outputs.dtype)
+        logits = tf.nn.bias_add(tf.matmul(outputs, tf.transpose(softmax_w),
+                                          name='softmax_transform_mle'),
+                                utils.cast_to(self.softmax_b, outputs.dtype))
+        return utils.cast_to(logits, tf.float32)
+
     def word_embeddings(self, inputs):
         '''Look up word embeddings for the input indices.'''
         with tf.device('/cpu:0'):
             embeds = tf.nn.embedding_lookup(self.embedding, inputs, name='word_embedding_lookup')
-        return embeds
+        return utils.cast_to(embeds, cfg.dtype)
 
-    def generator(self, inputs, mle_mode, reuse=None):
-        '''Use the word inputs to predict next words.'''
+    def generator(self, inputs, mle_mode, reuse=None, initial_state=None):
+        '''Use the word inputs to predict next words. The final state is float32.'''
+        if initial_state is not None:
+            initial_state = tuple(utils.cast_to(s, cfg.dtype) for s in initial_state)
         with tf.variable_scope("Generator", reuse=reuse):
-            if mle_mode:
-                cell = self.rnn_cell(cfg.num_layers, cfg.hidden_size, return_states=True,
-                                     pretanh=True)
+            if mle_mode and (cfg.fused_gru or cfg.recompute_every > 0):
+                outputs, final_state = self.fused_rnn(inputs, cfg.num_layers, cfg.hidden_size,
+                                                      pretanh=True, initial_state=initial_state)
             else:
-                cell = self.rnn_cell(cfg.num_layers, cfg.hidden_size, self.embedding,
-                                     self.softmax_w, self.softmax_b, return_states=True,
-                                     pretanh=True, get_embeddings=cfg.concat_inputs)
-            outputs, _ = tf.nn.dynamic_rnn(cell, inputs, swap_memory=True, dtype=tf.float32)
-            output = outputs[:, :, :cfg.hidden_size]
+                if mle_mode:
+                    cell = self.rnn_cell(cfg.num_layers, cfg.hidden_size, return_states=True,
+                                         pretanh=True)
+                else:
+                    if self.adaptive_softmax is not None:
+                        sampler = self.adaptive_softmax.sample
+                    else:
+                        sampler = None
+                    cell = self.rnn_cell(cfg.num_layers, cfg.hidden_size, self.embedding,
+                                         self.softmax_w, self.softmax_b, return_states=True,
+                                         pretanh=True, get_embeddings=cfg.concat_inputs,
+                                         sampler=sampler)
+                outputs, final_state = tf.nn.dynamic_rnn(cell, inputs,
+                                                         initial_state=initial_state,
+                                                         swap_memory=True, dtype=cfg.dtype)
+            final_state = tuple(utils.cast_to(s, tf.float32) for s in final_state)
+            output = outputs.output
+            states = list(outputs.states)
             if mle_mode:
                 generated = None
-                skip = 0
             else:
-                generated = tf.squeeze(tf.cast(outputs[:, :, cfg.hidden_size:cfg.hidden_size+1],
-                                               tf.int32), [-1])
-                skip = 1
-                if cfg.concat_inputs:
-                    embeddings = outputs[:, :, cfg.hidden_size+1:cfg.hidden_size+1+cfg.emb_size]
-                    embeddings = tf.concat(1, [inputs[:, :1, :], embeddings[:, :-1, :]])
-                    skip += cfg.emb_size
-            states = outputs[:, :, cfg.hidden_size+skip:]
+                generated = rnncell.prediction_ids(outputs.prediction)
             if cfg.concat_inputs:
                 if mle_mode:
-                    states = tf.concat(2, [states, inputs])
+                    states.append(inputs)
                 else:
-                    states = tf.concat(2, [states, embeddings])
-        return output, states, generated
+                    states.append(tf.concat(1, [inputs[:, :1, :],
+                                                outputs.embeddings[:, :-1, :]]))
+            states = tf.concat(2, states)
+        return output, states, generated, final_state
 
     def mle_loss(self, outputs, targets):
         '''Maximum likelihood estimation loss.'''
         # don't enfoce loss on true <unk>'s, makes the reported perlexity slightly overestimated
         mask = tf.cast(tf.not_equal(targets, self.vocab.unk_index, name='unk_mask'), tf.float32)
         output = tf.reshape(tf.concat(1, outputs), [-1, cfg.hidden_size])
-        if self.training and cfg.softmax_samples < len(self.vocab.vocab):
+        if self.adaptive_softmax is not None:
+            loss = self.adaptive_softmax.loss(output, tf.reshape(targets, [-1]))
+            loss *= tf.reshape(mask, [-1])
+        elif self.training and cfg.softmax_samples < len(self.vocab.vocab):
             targets = tf.reshape(targets, [-1, 1])
             mask = tf.reshape(mask, [-1])
-            loss = tf.nn.sampled_softmax_loss(self.softmax_w, self.softmax_b, output, targets,
+            # the sampled logits are few, compute them in float32
+            loss = tf.nn.sampled_softmax_loss(self.softmax_w, self.softmax_b,
+                                              utils.cast_to(output, tf.float32), targets,
                                               cfg.softmax_samples, len(self.vocab.vocab))
             loss *= mask
+        elif not self.training and cfg.eval_vocab_chunk > 0:
+            loss = self.chunked_softmax_loss(output, tf.reshape(targets, [-1]))
+            loss *= tf.reshape(mask, [-1])
         else:
-            logits = tf.nn.bias_add(tf.matmul(output, tf.transpose(self.softmax_w),
-                                              name='softmax_transform_mle'), self.softmax_b)
+            logits = self.output_logits(output)
             loss = tf.nn.seq2seq.sequence_loss_by_example([logits],
                                                           [tf.reshape(targets, [-1])],
                                                           [tf.reshape(mask, [-1])])
         return tf.reshape(loss, [cfg.batch_size, -1])
 
+    def chunked_softmax_loss(self, output, targets):
+        '''Exact full softmax cross-entropy of [positions, hidden_size] outputs without building
+           the logits of all positions against the whole vocab: eval_position_chunk positions
+           are done at a time, each streaming the log-sum-exp over eval_vocab_chunk words at a
+           time. For evaluation, there is no backprop.'''
+        vocab_size = len(self.vocab.vocab)
+        num_positions = output.get_shape()[0].value
+        position_chunk = num_positions
+        if cfg.eval_position_chunk > 0:
+            position_chunk = min(cfg.eval_position_chunk, num_positions)
+        num_chunks = -(-num_positions // position_chunk)
+        padding = num_chunks * position_chunk - num_positions
+        if padding:
+            output = tf.pad(output, [[0, padding], [0, 0]])
+            targets = tf.pad(targets, [[0, padding]])
+        output = tf.reshape(output, [num_chunks, position_chunk, -1])
+        targets = tf.reshape(targets, [num_chunks, position_chunk])
+        softmax_w = utils.cast_to(self.softmax_w, output.dtype)
+        softmax_b = utils.cast_to(self.softmax_b, output.dtype)
+        vocab_chunk = min(cfg.eval_vocab_chunk, vocab_size)
+
+        def chunk_loss(i):
+            chunk_output = tf.gather(output, i)
+
+            def logsumexp_step(start, max_logit, sum_exp):
+                size = tf.minimum(vocab_chunk, vocab_size - start)
+                logits = tf.matmul(chunk_output, tf.slice(softmax_w, [start, 0], [size, -1]),
+                                   transpose_b=True)
+                logits = tf.nn.bias_add(logits, tf.slice(softmax_b, [start], [size]))
+                logits = utils.cast_to(logits, tf.float32)
+                new_max = tf.maximum(max_logit, tf.reduce_max(logits, [1]))
+                sum_exp = sum_exp * tf.exp(max_logit - new_max) + \
+                    tf.reduce_sum(tf.exp(logits - tf.expand_dims(new_max, 1)), [1])
+                return start + vocab_chunk, new_max, sum_exp
+
+            # one vocab chunk at a time, so only one chunk of logits is alive
+            _, max_logit, sum_exp = tf.while_loop(
+                lambda start, max_logit, sum_exp: start < vocab_size, logsumexp_step,
+                [tf.constant(0), tf.fill([position_chunk], float('-inf')),
+                 tf.zeros([position_chunk])], parallel_iterations=1, back_prop=False)
+            chunk_targets = tf.gather(targets, i)
+            target_logits = tf.reduce_sum(chunk_output * tf.gather(softmax_w, chunk_targets),
+                                          [1]) + tf.gather(softmax_b, chunk_targets)
+            return max_logit + tf.log(sum_exp) - utils.cast_to(target_logits, tf.float32)
+
+        loss = tf.map_fn(chunk_loss, tf.range(num_chunks), dtype=tf.float32,
+                         parallel_iterations=1, back_prop=False)
+        return tf.reshape(loss, [-1])[:num_positions]
+
     def discriminator_rnn(self, states):
         '''Recurrent discriminator that operates on the sequence of states of the sentences.'''
         with tf.variable_scope("Discriminator"):
-            if cfg.d_rnn_bidirect:
+            fused = cfg.fused_gru or cfg.recompute_every > 0
+            if cfg.d_rnn_bidirect and fused:
+                # same variables as bidirectional_dynamic_rnn below
+                hidden_size = cfg.hidden_size
+                outputs = (self.fused_rnn(states, cfg.d_num_layers, hidden_size,
+                                          scope='BiRNN_FW')[0],
+                           self.fused_rnn(states, cfg.d_num_layers, hidden_size, reverse=True,
+                                          scope='BiRNN_BW')[0])
+            elif cfg.d_rnn_bidirect:
                 hidden_size = cfg.hidden_size
-                fcell = self.rnn_cell(cfg.d_num_layers, hidden_size, return_states=True)
-                bcell = self.rnn_cell(cfg.d_num_layers, hidden_size, return_states=True)
+                # the backward outputs are reversed by reverse_sequence, which needs a single
+                # tensor
+                fcell = self.rnn_cell(cfg.d_num_layers, hidden_size, return_states=True,
+                                      structured=False)
+                bcell = self.rnn_cell(cfg.d_num_layers, hidden_size, return_states=True,
+                                      structured=False)
                 seq_lengths = [cfg.max_sent_length] * (2 * cfg.batch_size)
                 outputs, _ = tf.nn.bidirectional_dynamic_rnn(fcell, bcell, states,
                                                              sequence_length=seq_lengths,
-                                                             swap_memory=True, dtype=tf.float32)
+                                                             swap_memory=True, dtype=cfg.dtype)
             else:
                 hidden_size = cfg.hidden_size * 2
-                cell = self.rnn_cell(cfg.d_num_layers, hidden_size, return_states=True)
-                outputs, _ = tf.nn.dynamic_rnn(cell, states, swap_memory=True, dtype=tf.float32)
+                if fused:
+                    outputs, _ = self.fused_rnn(states, cfg.d_num_layers, hidden_size)
+                else:
+                    cell = self.rnn_cell(cfg.d_num_layers, hidden_size, return_states=True)
+                    outputs, _ = tf.nn.dynamic_rnn(cell, states, swap_memory=True,
+                                                   dtype=cfg.dtype)
                 outputs = (outputs,)  # to match bidirectional RNN's output format
             d_states = []
             for out in outputs:
-                output = out[:, :, :hidden_size]
-                dir_states = out[:, :, hidden_size:]
                 # for GRU, we skipped the last layer states because they're the outputs
-                d_states.append(tf.concat(2, [dir_states, output]))
+                if isinstance(out, rnncell.RNNOutputs):
+                    d_states.extend(out.states + (out.output,))
+                else:
+                    d_states.extend([out[:, :, hidden_size:], out[:, :, :hidden_size]])
         return self._discriminator_conv(tf.concat(2, d_states))
 
     def _discriminator_conv(self, states):
-        '''Convolve output of bidirectional RNN and predict the discriminator label.'''
+        '''Convolve output of bidirectional RNN and predict the discriminator label (as
+           float32).'''
         with tf.variable_scope("Discriminator"):
             W_conv = tf.get_variable('W_conv', [cfg.d_conv_window, 1, states.get_shape()[2],
                                                 cfg.hidden_size // cfg.d_conv_window],
@@ -180,29 +388,52 @@ class RNNLMModel(object):
             b_conv = tf.get_variable('b_conv', [cfg.hidden_size // cfg.d_conv_window],
                                      initializer=tf.constant_initializer(0.0))
             states = tf.expand_dims(states, 2)
-            conv = tf.nn.conv2d(states, W_conv, strides=[1, 1, 1, 1], padding='SAME')
+            conv = tf.nn.conv2d(states, utils.cast_to(W_conv, states.dtype), strides=[1, 1, 1, 1],
+                                padding='SAME')
             conv_out = tf.reshape(conv, [2 * cfg.batch_size, -1,
                                          cfg.hidden_size // cfg.d_conv_window])
-            conv_out = tf.nn.elu(tf.nn.bias_add(conv_out, b_conv))
-            conv_out = tf.reshape(conv_out, [2 * cfg.batch_size, -1])
-            output = utils.linear(conv_out, 1, True, 0.0, scope='discriminator_output')
-        return output
+            conv_out = tf.nn.elu(tf.nn.bias_add(conv_out, utils.cast_to(b_conv, states.dtype)))
+            if cfg.d_pooling == 'flatten':
+                conv_out = tf.reshape(conv_out, [2 * cfg.batch_size, -1])
+                output = utils.linear(conv_out, 1, True, 0.0, scope='discriminator_output')
+            else:
+                # the output layer no longer depends on the sentence length, so it gets its
+                # own variables
+                output = utils.linear(self._pool_over_time(conv_out), 1, True, 0.0,
+                                      scope='discriminator_pooled_output')
+        return utils.cast_to(output, tf.float32)
+
+    def _pool_over_time(self, conv_out):
+        '''Pool [batch, time, channels] discriminator features over time, per d_pooling.'''
+        if cfg.d_pooling == 'max':
+            return tf.reduce_max(conv_out, [1])
+        elif cfg.d_pooling == 'mean':
+            return tf.reduce_mean(conv_out, [1])
+        elif cfg.d_pooling == 'attention':
+            channels = conv_out.get_shape()[2].value
+            scores = utils.linear(tf.reshape(conv_out, [-1, channels]), 1, True, 0.0,
+                                  scope='discriminator_attention')
+            scores = utils.cast_to(tf.reshape(scores, [2 * cfg.batch_size, -1]), tf.float32)
+            weights = utils.cast_to(tf.nn.softmax(scores), conv_out.dtype)
+            return tf.reduce_sum(conv_out * tf.expand_dims(weights, 2), [1])
+        raise ValueError('Unknown discriminator pooling: %s' % cfg.d_pooling)
 
     def discriminator_finalstate(self, states):
-        '''Discriminator that operates on the final states of the sentences.'''
+        '''Discriminator that operates on the final states of the sentences (float32
+           output).'''
         with tf.variable_scope("Discriminator"):
             lin1 = tf.nn.elu(utils.linear(states[:, -1, :], cfg.hidden_size, True, 0.0,
                                           scope='discriminator_lin1'))
             lin2 = tf.nn.elu(utils.linear(lin1, cfg.hidden_size // 2, True, 0.0,
                                           scope='discriminator_lin2'))
             output = utils.linear(lin2, 1, True, 0.0, scope='discriminator_output')
-        return output
+        return utils.cast_to(output, tf.float32)
 
     def discriminator_energy(self, states):
         '''An energy-based discriminator that tries to reconstruct the input states.'''
         with tf.variable_scope("Discriminator"):
             _, state = tf.nn.dynamic_rnn(self.rnn_cell(cfg.d_num_layers, cfg.hidden_size), states,
-                                         swap_memory=True, dtype=tf.float32,
+                                         swap_memory=True, dtype=cfg.dtype,
                                          scope='discriminator_encoder')
             # XXX use BiRNN+convnet for the encoder
             # this latent needs a more capacity than to reproduce the hidden states
@@ -211,7 +442,8 @@ class RNNLMModel(object):
                                             scope='discriminator_latent_transform'))
             latent = utils.highway(latent, layer_size=2, f=tf.nn.elu)
             decoder_input = tf.concat(1, [tf.zeros([2 * cfg.batch_size, 1,
-                                                    states.get_shape()[2].value]), states])
+                                                    states.get_shape()[2].value], cfg.dtype),
+                                          states])
             decoder_input = tf.concat(2, [decoder_input,
                                           tf.tile(tf.expand_dims(latent, 1),
                                                   [1, decoder_input.get_shape()[1].value, 1])])
@@ -219,7 +451,7 @@ class RNNLMModel(object):
             if cfg.concat_inputs:
                 hidden_size += cfg.emb_size
             output, _ = tf.nn.dynamic_rnn(self.rnn_cell(cfg.d_num_layers, hidden_size),
-                                          decoder_input, swap_memory=True, dtype=tf.float32,
+                                          decoder_input, swap_memory=True, dtype=cfg.dtype,
                                           scope='discriminator_decoder')
             output = tf.reshape(output, [-1, hidden_size])
             reconstructed = utils.linear(output, hidden_size, True, 0.0,
@@ -229,6 +461,8 @@ class RNNLMModel(object):
 
     def gan_energy_loss(self, states, targets):
         '''Return the GAN energy loss. Put no variables here.'''
+        states = utils.cast_to(states, tf.float32)
+        targets = utils.cast_to(targets, tf.float32)
         losses = tf.reduce_sum(tf.square(states - targets), [1, 2]) / cfg.max_sent_length
         d_losses = losses[:cfg.batch_size] + tf.nn.relu(cfg.d_eb_margin - losses[cfg.batch_size:])
         g_losses = losses[cfg.batch_size:]
@@ -239,24 +473,35 @@ class RNNLMModel(object):
            Put no variables here.'''
         return tf.nn.sigmoid_cross_entropy_with_logits(d_out, targets)
 
-    def _train(self, cost, scope, optimizer, global_step=None):
-        '''Generic training helper'''
+    def _train(self, costs, scope, optimizer, global_step=None):
+        '''Generic training helper, on the average of the gradients of the tower costs.'''
         tvars = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope=scope)
-        grads = tf.gradients(cost, tvars)
+        tower_grads = []
+        for cost in costs:
+            if cfg.loss_scale != 1.0:
+                # scaled up through the reduced-precision backward pass, then back on the
+                # float32 gradients of the variables
+                grads = [utils.scale_gradient(grad, 1.0 / cfg.loss_scale)
+                         for grad in tf.gradients(cost * cfg.loss_scale, tvars)]
+            else:
+                grads = tf.gradients(cost, tvars)
+            tower_grads.append(grads)
+        if len(tower_grads) > 1:
+            grads = [utils.average_gradients(grads) for grads in zip(*tower_grads)]
         if cfg.max_grad_norm > 0:
             grads, _ = tf.clip_by_global_norm(grads, cfg.max_grad_norm)
         return optimizer.apply_gradients(zip(grads, tvars), global_step=global_step)
 
-    def train_mle(self, cost):
+    def train_mle(self, costs):
         '''Training op for MLE mode.'''
-        return self._train(cost, '.*/(Embeddings|Generator|MLE_Softmax)', self.g_optimizer,
-                           self.global_step)
+        return self._train(costs, '.*/(Embeddings|Generator|MLE_Softmax|Adaptive_Softmax)',
+                           self.g_optimizer, self.global_step)
 
-    def train_d(self, cost):
+    def train_d(self, costs):
         '''Training op for GAN mode, discriminator.'''
-        return self._train(cost, '.*/Discriminator', self.d_optimizer)
+        return self._train(costs, '.*/Discriminator', self.d_optimizer)
 
-    def train_g(self, cost):
+    def train_g(self, costs):
         '''Training op for GAN mode, generator.'''
         # don't update embeddings, just update the generated distributions
-        return self._train(cost, '.*/Generator', self.g_optimizer)
+        return self._train(costs, '.*/Generator', self.g_optimizer)
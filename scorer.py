@@ -0,0 +1,119 @@
+import collections
+import itertools
+import multiprocessing
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from checkpoint import resolve
+from config import cfg
+from reader import Vocab
+from rnnlm import RNNLMModel
+
+
+class Scorer(object):
+
+    '''Scores sentences with the MLE path of a model. Sentences are token id arrays without
+       <sos>; each row of a batch is the <sos> that starts a sentence followed by its tokens and
+       <sos> padding, so the first padding token is scored as the end of the sentence. Sentences
+       longer than max_sent_length - 1 tokens are truncated.'''
+
+    def __init__(self, model):
+        self.model = model
+        self.vocab = model.vocab
+
+    def pack(self, sentences):
+        '''Pack up to batch_size sentences into a batch, returning it with the number of
+           tokens scored per sentence.'''
+        batch = np.full([cfg.batch_size, cfg.max_sent_length], self.vocab.sos_index,
+                        dtype=np.int32)
+        lengths = np.zeros([len(sentences)], dtype=np.int32)
+        for i, sent in enumerate(sentences):
+            sent = sent[:cfg.max_sent_length - 1]
+            batch[i, 1:len(sent) + 1] = sent
+            # the sentence tokens and the <sos> ending it
+            lengths[i] = len(sent) + 1
+        return batch, lengths
+
+    def score(self, session, sentences):
+        '''Log-likelihoods of up to batch_size sentences, and the number of tokens scored for
+           each.'''
+        batch, lengths = self.pack(sentences)
+        losses = session.run(self.model.losses, {self.model.data: batch})[:len(sentences)]
+        mask = np.arange(cfg.max_sent_length) < lengths[:, None]
+        return -np.sum(losses * mask, 1, dtype=np.float64), lengths
+
+
+_worker = None  # (vocab, session, scorer) of a scoring worker process
+
+
+def _init_worker(vocab, threads):
+    '''Build the model and restore it in a session of this worker process.'''
+    global _worker
+    graph = tf.Graph()
+    with graph.as_default():
+        with tf.variable_scope("Model"):
+            model = RNNLMModel(vocab, False, False, eval_only=True)
+        saver = tf.train.Saver()
+    config_proto = tf.ConfigProto(intra_op_parallelism_threads=threads,
+                                  inter_op_parallelism_threads=threads)
+    if not cfg.preallocate_gpu:
+        config_proto.gpu_options.allow_growth = True
+    session = tf.Session(graph=graph, config=config_proto)
+    saver.restore(session, resolve(cfg.load_file))
+    _worker = (vocab, session, Scorer(model))
+
+
+def _score_lines(lines):
+    '''Tokenize and score up to batch_size lines in a worker.'''
+    vocab, session, scorer = _worker
+    return scorer.score(session, [vocab.line_ids(line) for line in lines])
+
+
+def _pool_scores(pool, f, num_workers):
+    '''Scores of the batches of lines of f from the pool workers, in input order, with a bounded
+       number of batches in flight.'''
+    in_flight = collections.deque()
+    for lines in iter(lambda: list(itertools.islice(f, cfg.batch_size)), []):
+        in_flight.append(pool.apply_async(_score_lines, (lines,)))
+        if len(in_flight) >= 2 * num_workers:
+            yield in_flight.popleft().get()
+    while in_flight:
+        yield in_flight.popleft().get()
+
+
+def main(_):
+    if not cfg.score_input:
+        print("You need to provide a file to score with --score_input!")
+        sys.exit(1)
+    vocab = Vocab()
+    vocab.load()
+
+    # split the cores between the sessions of the workers
+    threads = max(1, multiprocessing.cpu_count() // cfg.score_workers)
+    start_time = time.time()
+    sentences = 0
+    log_likelihood = 0.0
+    tokens = 0
+    with open(cfg.score_input, 'r') as f_in, open(cfg.score_output, 'w') as f_out, \
+            multiprocessing.Pool(cfg.score_workers, _init_worker, (vocab, threads)) as pool:
+        for step, (lls, lengths) in enumerate(_pool_scores(pool, f_in, cfg.score_workers)):
+            f_out.writelines('%.4f\t%d\n' % (ll, n) for ll, n in zip(lls, lengths))
+            sentences += len(lls)
+            log_likelihood += np.sum(lls)
+            tokens += np.sum(lengths)
+            if (step + 1) % cfg.print_every == 0:
+                print("%d sentences, %.0f sentences/sec" % (sentences,
+                                                            sentences / (time.time() - start_time)))
+    elapsed = time.time() - start_time
+    print("Scored %d sentences in %.2fs: %.0f sentences/sec" % (sentences, elapsed,
+                                                                  sentences / elapsed))
+    if tokens:
+        print("Perplexity: %.3f" % np.exp(-log_likelihood / tokens))
+    print("Scores written to", cfg.score_output)
+
+
+if __name__ == "__main__":
+    tf.app.run()
@@ -0,0 +1,261 @@
+import collections
+import http.server
+import json
+import os
+import queue
+import socketserver
+import sys
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from checkpoint import resolve
+from config import cfg
+from decoder import Decoder
+from reader import Vocab
+from rnnlm import RNNLMModel
+from scorer import Scorer
+import utils
+
+
+class Request(object):
+
+    '''A generate or score request of one or more rows, which may be split across batches.
+       Only requests with the same kind and key (the sampling parameters) share a batch.'''
+
+    def __init__(self, kind, key, items):
+        self.kind = kind
+        self.key = key
+        self.items = items
+        self.results = [None] * len(items)
+        self.scheduled = 0  # rows handed to batches so far
+        self.finished = 0
+        self.error = None
+        self.arrival = time.time()
+        self.done = threading.Event()
+
+
+class Batcher(object):
+
+    '''Runs requests from many client threads in full batch_size batches on a single session
+       thread. A batch is started when it is full or when its oldest request has waited for
+       max_delay seconds.'''
+
+    def __init__(self, session, decoder, scorer, max_delay):
+        self.session = session
+        self.decoder = decoder
+        self.scorer = scorer
+        self.max_delay = max_delay
+        self.queue = queue.Queue()
+        self.pending = collections.deque()
+        self.stats_lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=10000)
+        self.batches = 0
+        self.rows = 0
+        self.requests = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, request):
+        '''Queue the request and wait for its results.'''
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.results
+
+    def stats(self):
+        '''Queue depth, batch fill ratio and latency percentiles in seconds.'''
+        with self.stats_lock:
+            latencies = list(self.latencies)
+            fill = self.rows / (self.batches * cfg.batch_size) if self.batches else 0.0
+            stats = {'queue_depth': self.queue.qsize() + len(self.pending),
+                     'batches': self.batches, 'fill_ratio': fill,
+                     'requests': self.requests}
+        if latencies:
+            stats['p50_latency'], stats['p99_latency'] = np.percentile(latencies, [50, 99])
+        return stats
+
+    def _compatible_rows(self, first):
+        return sum(len(r.items) - r.scheduled for r in self.pending
+                   if (r.kind, r.key) == (first.kind, first.key))
+
+    def _run(self):
+        while True:
+            if not self.pending:
+                self.pending.append(self.queue.get())
+            first = self.pending[0]
+            # wait for more requests until the batch is full or the oldest one is due
+            while self._compatible_rows(first) < cfg.batch_size:
+                timeout = first.arrival + self.max_delay - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    self.pending.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            while True:
+                try:
+                    self.pending.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            rows = []
+            for request in list(self.pending):
+                if (request.kind, request.key) != (first.kind, first.key):
+                    continue
+                count = min(cfg.batch_size - len(rows), len(request.items) - request.scheduled)
+                rows.extend((request, i) for i in range(request.scheduled,
+                                                        request.scheduled + count))
+                request.scheduled += count
+                if request.scheduled == len(request.items):
+                    self.pending.remove(request)
+                if len(rows) == cfg.batch_size:
+                    break
+            self._run_batch(first.kind, first.key, rows)
+
+    def _run_batch(self, kind, key, rows):
+        try:
+            if kind == 'score':
+                lls, lengths = self.scorer.score(self.session, [r.items[i] for r, i in rows])
+                results = [{'log_likelihood': float(ll), 'tokens': int(n)}
+                           for ll, n in zip(lls, lengths)]
+            else:
+                num_steps, temperature, top_k, top_p, prompt = key
+                output = self.decoder.sample(self.session, num_steps, temperature, top_k, top_p,
+                                             prompt=prompt)
+                results = [self._sentence(sent) for sent in output[:len(rows)]]
+            error = None
+        except Exception as e:  # re-raised in the client threads
+            results = [None] * len(rows)
+            error = e
+        now = time.time()
+        with self.stats_lock:
+            self.batches += 1
+            self.rows += len(rows)
+            for (request, i), result in zip(rows, results):
+                request.results[i] = result
+                request.finished += 1
+                if error is not None:
+                    request.error = error
+                if request.finished == len(request.items):
+                    self.requests += 1
+                    self.latencies.append(now - request.arrival)
+                    request.done.set()
+
+    def _sentence(self, sent):
+        '''Text of a generated sentence, up to the <sos> that ends it.'''
+        ends = np.flatnonzero(sent == self.decoder.vocab.sos_index)
+        if len(ends):
+            sent = sent[:ends[0]]
+        return utils.sentence_text(sent, self.decoder.vocab, cfg.char_model).strip()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+
+    '''POST /generate {"n", "length", "temperature", "top_k", "top_p", "prompt"} for n
+       sentences (continuing the prompt text, if given), POST /score {"sentences": [...]} for
+       their log-likelihoods, GET /stats.'''
+
+    batcher = None
+    vocab = None
+
+    def _reply(self, code, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._reply(200, self.batcher.stats())
+        else:
+            self._reply(404, {'error': 'unknown path'})
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            args = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+            if self.path == '/generate':
+                key = (int(args.get('length', cfg.gen_length or cfg.max_sent_length)),
+                       float(args.get('temperature', cfg.temperature)),
+                       int(args.get('top_k', cfg.top_k)), float(args.get('top_p', cfg.top_p)),
+                       tuple(self.vocab.line_ids(args['prompt'])) if 'prompt' in args else None)
+                num_sentences = int(args.get('n', 1))
+                if num_sentences < 1 or key[0] < 1:
+                    raise ValueError('n and length must be positive')
+                request = Request('generate', key, [None] * num_sentences)
+                self._reply(200, {'sentences': self.batcher.submit(request)})
+            elif self.path == '/score':
+                sentences = [self.vocab.line_ids(line) for line in args['sentences']]
+                if not sentences:
+                    raise ValueError('no sentences to score')
+                request = Request('score', None, sentences)
+                self._reply(200, {'scores': self.batcher.submit(request)})
+            else:
+                self._reply(404, {'error': 'unknown path'})
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {'error': str(e)})
+        except Exception as e:
+            self._reply(500, {'error': str(e)})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(address):
+    '''HTTP server on host:port, or on a Unix socket path.'''
+    if ':' in address and not address.startswith('/'):
+        host, port = address.rsplit(':', 1)
+        return ThreadingHTTPServer((host, int(port)), Handler)
+    if os.path.exists(address):
+        os.remove(address)
+    return ThreadingUnixServer(address, Handler)
+
+
+def main(_):
+    vocab = Vocab()
+    vocab.load()
+
+    config_proto = tf.ConfigProto()
+    if not cfg.preallocate_gpu:
+        config_proto.gpu_options.allow_growth = True
+    with tf.Graph().as_default(), tf.Session(config=config_proto) as session:
+        with tf.variable_scope("Model") as scope:
+            model = RNNLMModel(vocab, False, False, eval_only=True)
+            scope.reuse_variables()
+            decoder = Decoder(model)
+        saver = tf.train.Saver()
+        try:
+            saver.restore(session, resolve(cfg.load_file))
+        except ValueError:
+            print("You need to provide a valid model file for serving!")
+            sys.exit(1)
+        print("Model restored from", cfg.load_file)
+
+        Handler.batcher = Batcher(session, decoder, Scorer(model), cfg.batch_delay)
+        Handler.vocab = vocab
+        server = make_server(cfg.serve_address)
+        print("Serving on", cfg.serve_address)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            print('Stats:', Handler.batcher.stats())
+
+
+if __name__ == "__main__":
+    tf.app.run()
@@ -0,0 +1,106 @@
+import numpy as np
+import tensorflow as tf
+
+import utils
+
+
+class AdaptiveSoftmax(object):
+
+    '''Adaptive softmax (cf. https://arxiv.org/abs/1609.04309). The words are ordered by
+       frequency and split at the cutoffs: the head cluster holds the most frequent words and one
+       entry per tail cluster, and each tail cluster is predicted from a smaller projection of the
+       output (the hidden size divided by 4 for each further cluster). The log-probability of a
+       tail word is that of its cluster in the head plus its own within the cluster.'''
+
+    def __init__(self, counts, cutoffs, hidden_size, scope=None):
+        vocab_size = len(counts)
+        # most frequent first, ties in id order
+        id_of_rank = np.argsort(-np.asarray(counts), kind='mergesort').astype(np.int32)
+        rank_of_id = np.empty_like(id_of_rank)
+        rank_of_id[id_of_rank] = np.arange(vocab_size, dtype=np.int32)
+        self.cutoffs = [c for c in sorted(cutoffs) if 0 < c < vocab_size] + [vocab_size]
+        self.vocab_size = vocab_size
+        self.id_of_rank = tf.constant(id_of_rank)
+        self.rank_of_id = tf.constant(rank_of_id)
+        head_size = self.cutoffs[0] + len(self.cutoffs) - 1
+        with tf.variable_scope(scope or "Adaptive_Softmax"):
+            self.head_w = tf.get_variable("head_W", [head_size, hidden_size],
+                                          initializer=tf.contrib.layers.xavier_initializer())
+            self.head_b = tf.get_variable("head_b", [head_size], initializer=tf.zeros_initializer)
+            self.tails = []
+            for i in range(len(self.cutoffs) - 1):
+                size = self.cutoffs[i + 1] - self.cutoffs[i]
+                proj_size = max(1, hidden_size // 4 ** (i + 1))
+                with tf.variable_scope("Tail%d" % i):
+                    proj = tf.get_variable("proj", [hidden_size, proj_size],
+                                           initializer=tf.contrib.layers.xavier_initializer())
+                    w = tf.get_variable("W", [size, proj_size],
+                                        initializer=tf.contrib.layers.xavier_initializer())
+                    b = tf.get_variable("b", [size], initializer=tf.zeros_initializer)
+                self.tails.append((proj, w, b))
+
+    def _head_logits(self, outputs):
+        '''float32 logits of the head cluster.'''
+        logits = tf.nn.bias_add(tf.matmul(outputs, utils.cast_to(self.head_w, outputs.dtype),
+                                          transpose_b=True),
+                                utils.cast_to(self.head_b, outputs.dtype))
+        return utils.cast_to(logits, tf.float32)
+
+    def _tail_logits(self, i, outputs):
+        '''float32 logits of the words of tail cluster i.'''
+        proj, w, b = self.tails[i]
+        projected = tf.matmul(outputs, utils.cast_to(proj, outputs.dtype))
+        logits = tf.nn.bias_add(tf.matmul(projected, utils.cast_to(w, outputs.dtype),
+                                          transpose_b=True),
+                                utils.cast_to(b, outputs.dtype))
+        return utils.cast_to(logits, tf.float32)
+
+    def loss(self, outputs, targets):
+        '''Negative log-likelihood of the [positions] targets from [positions, hidden_size]
+           outputs. The tail clusters are only computed for the positions whose targets are in
+           them.'''
+        num_positions = outputs.get_shape()[0].value
+        head_size = self.cutoffs[0]
+        ranks = tf.gather(self.rank_of_id, targets)
+        head_targets = ranks
+        for i, cutoff in enumerate(self.cutoffs[:-1]):
+            # words past a cutoff are represented by their cluster in the head
+            head_targets = tf.select(ranks >= cutoff, tf.fill([num_positions], head_size + i),
+                                     head_targets)
+        head_logprobs = tf.nn.log_softmax(self._head_logits(outputs))
+        nll = -utils.rowwise_lookup(head_logprobs, head_targets)
+        nll = tf.reshape(nll, [num_positions])
+        for i in range(len(self.tails)):
+            low, high = self.cutoffs[i], self.cutoffs[i + 1]
+            rows = tf.to_int32(tf.reshape(tf.where(tf.logical_and(ranks >= low, ranks < high)),
+                                          [-1]))
+            tail_logprobs = tf.nn.log_softmax(self._tail_logits(i, tf.gather(outputs, rows)))
+            flat_indices = tf.range(tf.shape(rows)[0]) * (high - low) + \
+                tf.gather(ranks, rows) - low
+            tail_nll = -tf.gather(tf.reshape(tail_logprobs, [-1]), flat_indices)
+            nll += tf.unsorted_segment_sum(tail_nll, rows, num_positions)
+        return nll
+
+    def log_probs(self, outputs):
+        '''Full [positions, vocab_size] log-probabilities, in vocab id order.'''
+        head_size = self.cutoffs[0]
+        head_logprobs = tf.nn.log_softmax(self._head_logits(outputs))
+        parts = [head_logprobs[:, :head_size]]
+        for i in range(len(self.tails)):
+            parts.append(head_logprobs[:, head_size + i:head_size + i + 1] +
+                         tf.nn.log_softmax(self._tail_logits(i, outputs)))
+        by_rank = tf.concat(1, parts)
+        return tf.transpose(tf.gather(tf.transpose(by_rank), self.rank_of_id))
+
+    def sample(self, outputs):
+        '''Sample a word id for each row of [batch, hidden_size] outputs, first the head entry
+           and then, for a cluster, the word within it.'''
+        head_size = self.cutoffs[0]
+        ranks = tf.to_int32(tf.squeeze(tf.multinomial(self._head_logits(outputs), 1), [1]))
+        head_samples = ranks
+        for i in range(len(self.tails)):
+            tail_samples = tf.to_int32(tf.squeeze(tf.multinomial(self._tail_logits(i, outputs),
+                                                                 1), [1]))
+            ranks = tf.select(tf.equal(head_samples, head_size + i),
+                              tail_samples + self.cutoffs[i], ranks)
+        return tf.to_int64(tf.gather(self.id_of_rank, ranks))
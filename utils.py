@@ -1,9 +1,10 @@
 import itertools
-import re
 
 import numpy as np
 import tensorflow as tf
 
+from wordnorm import fix_word
+
 
 class Scheduler(object):
 
@@ -37,6 +38,15 @@ class Scheduler(object):
         if len(self.perps) > self.list_size:
             self.perps.pop()
 
+    def history(self):
+        '''Observation history, for saving along with the model.'''
+        return {'d_accs': list(self.d_accs), 'perps': list(self.perps)}
+
+    def restore(self, history):
+        '''Restore an observation history saved along with the model.'''
+        self.d_accs = list(history['d_accs'])
+        self.perps = list(history['perps'])
+
     def _current_perp(self):
         '''Smooth approximation of current perplexity.'''
         if not self.perps:
@@ -73,33 +83,22 @@ class Scheduler(object):
             return False
 
 
-fix_re = re.compile(r'''[^a-z0-9"'?.,]+''')
-num_re = re.compile(r'[0-9]+')
-
-
-def fix_word(word):
-    word = word.lower()
-    word = fix_re.sub('', word)
-    word = num_re.sub('#', word)
-    return word
-
-
-def display_sentences(output, vocab, char_model):
-    '''Display sentences from indices.'''
+def sentence_text(sent, vocab, char_model):
+    '''Text of a sentence of indices, with <sos> shown as a full stop.'''
     if char_model:
         space = ''
         nospace = ' '
     else:
         space = ' '
         nospace = ''
+    return ''.join(nospace + '. ' if word == vocab.sos_index else vocab.vocab[word] + space
+                   for word in sent)
+
+
+def display_sentences(output, vocab, char_model):
+    '''Display sentences from indices.'''
     for i, sent in enumerate(output):
-        print('Sentence %d:' % i, end=' ')
-        for word in sent:
-            if word == vocab.sos_index:
-                print(nospace + '. ', end='')
-            else:
-                print(vocab.vocab[word], end=space)
-        print()
+        print('Sentence %d:' % i, sentence_text(sent, vocab, char_model))
     print()
 
 
@@ -170,6 +169,39 @@ def rowwise_lookup(params, indices):
     return tf.gather(flattened, flattened_indices)
 
 
+def cast_to(tensor, dtype):
+    '''Cast a tensor (such as a float32 master variable) to the compute dtype, if needed.'''
+    if tensor.dtype.base_dtype == dtype:
+        return tensor
+    return tf.cast(tensor, dtype)
+
+
+def scale_gradient(grad, scale):
+    '''Multiply a gradient, which may be IndexedSlices, by scale.'''
+    if grad is None:
+        return None
+    if isinstance(grad, tf.IndexedSlices):
+        return tf.IndexedSlices(grad.values * scale, grad.indices, grad.dense_shape)
+    return grad * scale
+
+
+def average_gradients(grads):
+    '''Average the gradients of a variable from several towers, which may be IndexedSlices or
+       None.'''
+    grads = [grad for grad in grads if grad is not None]
+    if not grads:
+        return None
+    if any(isinstance(grad, tf.IndexedSlices) for grad in grads):
+        # the sparse rows of all the towers together, scaled
+        grads = [grad if isinstance(grad, tf.IndexedSlices) else
+                 tf.IndexedSlices(grad, tf.range(tf.shape(grad)[0]), tf.shape(grad))
+                 for grad in grads]
+        return tf.IndexedSlices(tf.concat(0, [grad.values for grad in grads]) / len(grads),
+                                tf.concat(0, [grad.indices for grad in grads]),
+                                grads[0].dense_shape)
+    return tf.add_n(grads) / len(grads)
+
+
 def linear(args, output_size, bias, bias_start=0.0, scope=None, train=True, initializer=None):
     """Linear map: sum_i(args[i] * W[i]), where W[i] is a variable.
     Args:
@@ -180,7 +212,8 @@ def linear(args, output_size, bias, bias_start=0.0, scope=None, train=True, init
         scope: VariableScope for the created subgraph; defaults to "Linear".
     Returns:
         A 2D Tensor with shape [batch x output_size] equal to
-        sum_i(args[i] * W[i]), where W[i]s are newly created matrices.
+        sum_i(args[i] * W[i]), where W[i]s are newly created matrices. The variables are
+        float32 and cast to the dtype of args.
     Raises:
         ValueError: if some of the arguments has unspecified or wrong shape.
     Based on the code from TensorFlow."""
@@ -204,18 +237,19 @@ def linear(args, output_size, bias, bias_start=0.0, scope=None, train=True, init
         initializer = tf.contrib.layers.xavier_initializer()
     # Now the computation.
     with tf.variable_scope(scope or "Linear"):
-        matrix = tf.get_variable("Matrix", [total_arg_size, output_size], dtype=dtype,
+        matrix = tf.get_variable("Matrix", [total_arg_size, output_size],
                                  initializer=initializer, trainable=train)
+        matrix = cast_to(matrix, dtype)
         if len(args) == 1:
             res = tf.matmul(args[0], matrix)
         else:
             res = tf.matmul(tf.concat(1, args), matrix)
         if not bias:
             return res
-        bias_term = tf.get_variable("Bias", [output_size], dtype=dtype,
-                                    initializer=tf.constant_initializer(bias_start, dtype=dtype),
+        bias_term = tf.get_variable("Bias", [output_size],
+                                    initializer=tf.constant_initializer(bias_start),
                                     trainable=train)
-    return res + bias_term
+    return res + cast_to(bias_term, dtype)
 
 
 def highway(input_, layer_size=1, bias=-2, f=tf.nn.tanh, scope=None):
@@ -0,0 +1,116 @@
+'''Compact vocabulary store that loads by memory-mapping instead of unpickling.
+
+File layout (little-endian): the magic, the vocab size V, the string blob length and the
+source key length, the source key (identifying what the file was built from, zero-padded to
+8 bytes), then int64 offsets[V + 1] into the blob, int64 counts[V], int32 ids sorted by their
+UTF-8 bytes (the index used for lookups) and the UTF-8 blob of all words concatenated in id
+order. Only NumPy is needed, so tools can read the vocab without importing TensorFlow.'''
+
+import os
+
+import numpy as np
+
+
+MAGIC = b'TGVOCAB2'
+
+
+class StringTable(object):
+
+    '''Read-only sequence of the words, decoded on access.'''
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def raw(self, index):
+        '''UTF-8 bytes of a word.'''
+        return self.blob[self.offsets[index]:self.offsets[index + 1]].tobytes()
+
+    def __getitem__(self, index):
+        index = int(index)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('vocab index out of range')
+        return self.raw(index).decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.raw(i).decode('utf-8')
+
+
+class StringIndex(object):
+
+    '''Read-only word to id mapping, by binary search over the sorted index.'''
+
+    def __init__(self, table, order):
+        self.table = table
+        self.order = order
+
+    def __len__(self):
+        return len(self.order)
+
+    def get(self, word, default=None):
+        key = word.encode('utf-8')
+        lo, hi = 0, len(self.order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.table.raw(self.order[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.order) and self.table.raw(self.order[lo]) == key:
+            return int(self.order[lo])
+        return default
+
+    def __getitem__(self, word):
+        index = self.get(word)
+        if index is None:
+            raise KeyError(word)
+        return index
+
+    def __contains__(self, word):
+        return self.get(word) is not None
+
+
+def save(path, words, counts, key=b''):
+    '''Write the words (in id order) and their counts, with the key of their source.'''
+    encoded = [w.encode('utf-8') for w in words]
+    offsets = np.zeros([len(encoded) + 1], dtype=np.int64)
+    np.cumsum([len(w) for w in encoded], out=offsets[1:])
+    order = np.array(sorted(range(len(encoded)), key=encoded.__getitem__), dtype=np.int32)
+    tmp_path = str(path) + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        np.array([len(encoded), offsets[-1], len(key)], dtype='<i8').tofile(f)
+        f.write(key + b'\0' * (-len(key) % 8))
+        offsets.astype('<i8').tofile(f)
+        np.asarray(counts, dtype='<i8').tofile(f)
+        order.astype('<i4').tofile(f)
+        f.write(b''.join(encoded))
+    os.replace(tmp_path, str(path))
+
+
+def load(path, key=None):
+    '''Memory-map a vocab file, returning the word table, the word index and the counts. If
+       key is given, the file must have been saved with it.'''
+    data = np.memmap(str(path), dtype=np.uint8, mode='r')
+    if data[:len(MAGIC)].tobytes() != MAGIC:
+        raise IOError('%s is not a vocab file' % path)
+    pos = len(MAGIC)
+    size, blob_size, key_size = data[pos:pos + 24].view('<i8')
+    pos += 24
+    if key is not None and data[pos:pos + key_size].tobytes() != key:
+        raise IOError('%s was built from another source' % path)
+    pos += key_size + (-key_size % 8)
+    offsets = data[pos:pos + 8 * (size + 1)].view('<i8')
+    pos += 8 * (size + 1)
+    counts = data[pos:pos + 8 * size].view('<i8')
+    pos += 8 * size
+    order = data[pos:pos + 4 * size].view('<i4')
+    pos += 4 * size
+    table = StringTable(data[pos:pos + blob_size], offsets)
+    return table, StringIndex(table, order), counts
@@ -0,0 +1,15 @@
+'''Normalization of the words of the dataset, shared by the reader and the NumPy engine (see
+npengine), so it only needs the standard library.'''
+
+import re
+
+
+fix_re = re.compile(r'''[^a-z0-9"'?.,]+''')
+num_re = re.compile(r'[0-9]+')
+
+
+def fix_word(word):
+    word = word.lower()
+    word = fix_re.sub('', word)
+    word = num_re.sub('#', word)
+    return word